@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""Load test mail-to-oncall with a storm of concurrent alerts, against a local fake Google.
+
+Starts benchmarks/fake_google.py, optionally primes the cache with a sync,
+puts the fake Google in the requested mode and then runs mail-to-oncall for
+every alert, as many at a time as asked for, with a stub mail command that
+records who each alert was sent to. Reports throughput, latency percentiles,
+how many alerts went to the fallback address and how many requests reached
+the fake Google during the storm.
+
+With --snapshot, mail-to-oncall is given the snapshot file that each sync
+writes (-n), and with --serve it asks nagcal --serve over its socket (-S),
+before falling back to running nagcal --current.
+
+usage: python benchmarks/alert_storm.py [--alerts N] [--concurrency N] [--mode MODE] [--cache STATE]
+       [--snapshot] [--serve] [--option name=value ...]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+from distutils.spawn import find_executable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NAGCAL = os.path.join(ROOT, "scripts", "nagcal")
+MAIL_TO_ONCALL = os.path.join(ROOT, "scripts", "mail-to-oncall")
+FALLBACK = "fallback@example.com"
+CACHE_STATES = ("cold", "stale", "fresh")
+sys.path.insert(0, ROOT)
+import fake_google # pylint: disable=W0403
+from sync_bench import CONFIGURATION, write_credentials, percentile # pylint: disable=W0403
+
+# stand-in for mail: discards the message and records its recipient, the last argument
+STUB_MAIL = """#!/bin/sh
+cat > /dev/null
+for recipient; do :; done
+echo "$recipient" >> "%s"
+"""
+
+# stand-in for nc -U -w SECONDS SOCKET, for systems without an nc that speaks to Unix sockets
+STUB_NC = """#!%s
+import sys
+import socket
+client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+client.settimeout(float(sys.argv[sys.argv.index("-w") + 1]))
+client.connect(sys.argv[-1])
+client.sendall(sys.stdin.read())
+client.shutdown(socket.SHUT_WR)
+while True:
+    data = client.recv(4096)
+    if not data:
+        break
+    sys.stdout.write(data)
+"""
+
+def run_alert(number, directory, environment, arguments):
+    """Run mail-to-oncall for one alert with extra arguments and return (seconds taken, exit status)."""
+    started = time.time()
+    process = subprocess.Popen(["bash", MAIL_TO_ONCALL, "-f", os.path.join(directory, "nagcal.cfg"),
+            "-w", directory] + arguments + ["-s", "PROBLEM alert %d" % number, FALLBACK],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=environment)
+    process.communicate("Service is CRITICAL\n")
+    return time.time() - started, process.returncode
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--alerts", type="int", default=200, help="number of alerts (default 200)")
+    parser.add_option("--concurrency", type="int", default=0,
+            help="alerts handled at the same time (default all of them)")
+    parser.add_option("--mode", choices=fake_google.MODES, default="healthy",
+            help="how the fake Google behaves during the storm, one of %s (default healthy)" %
+                ", ".join(fake_google.MODES))
+    parser.add_option("--delay", type="float", default=5.0,
+            help="seconds each response is delayed in slow mode (default 5)")
+    parser.add_option("--cache", choices=CACHE_STATES, default="stale",
+            help="state of the cache when the storm starts, one of %s (default stale)" %
+                ", ".join(CACHE_STATES))
+    parser.add_option("--snapshot", action="store_true", default=False,
+            help="have mail-to-oncall read the snapshot file written by each sync")
+    parser.add_option("--serve", action="store_true", default=False,
+            help="run nagcal --serve and have mail-to-oncall ask it over its socket")
+    parser.add_option("--shifts", type="int", default=1000, help="number of shifts (default 1000)")
+    parser.add_option("--people", type="int", default=50, help="number of distinct people (default 50)")
+    parser.add_option("--option", action="append", default=[], metavar="NAME=VALUE",
+            help="extra nagcal.cfg setting, e.g. cache_stale_ttl=900 (may be repeated)")
+    parser.add_option("--json", action="store_true", default=False, help="print the report as JSON")
+    options, _ = parser.parse_args()
+    concurrency = options.concurrency or options.alerts
+
+    server = fake_google.start(shifts=options.shifts, people=options.people, delay=options.delay)
+    directory = tempfile.mkdtemp(prefix="nagcal-storm-")
+    daemon = None
+    try:
+        write_credentials(os.path.join(directory, "credentials"), server.url(fake_google.TOKEN_PATH))
+
+        def write_configuration(settings):
+            """Write nagcal.cfg for the fake Google, with extra settings given as name=value strings."""
+            with open(os.path.join(directory, "nagcal.cfg"), 'w') as config_file:
+                config_file.write(CONFIGURATION % {
+                        'calendar_url': server.url(fake_google.CALENDAR_PATH),
+                        'contacts_url': server.url(fake_google.CONTACTS_PATH),
+                        'cache_backend': "text",
+                        'directory': directory,
+                        })
+                config_file.write("[nagcal]\n") # merged into the section above, overriding it
+                for setting in settings:
+                    name, value = setting.split("=", 1)
+                    config_file.write("%s = %s\n" % (name.strip(), value.strip()))
+
+        sent = os.path.join(directory, "sent")
+        mail = os.path.join(directory, "mail")
+        with open(mail, 'w') as mail_file:
+            mail_file.write(STUB_MAIL % sent)
+        os.chmod(mail, 0o755)
+        environment = dict(os.environ, PYTHONPATH=ROOT, MAIL_PATH=mail,
+                NAGCAL_PATH="%s %s" % (sys.executable, NAGCAL))
+
+        settings = list(options.option)
+        arguments = []
+        if options.snapshot:
+            snapshot_file = os.path.join(directory, "nagcal.snapshot")
+            settings.append("snapshot_file=%s" % snapshot_file)
+            arguments += ["-n", snapshot_file]
+        if options.serve:
+            socket_file = os.path.join(directory, "nagcal.sock")
+            settings.append("socket_file=%s" % socket_file)
+            arguments += ["-S", socket_file]
+            if find_executable("nc") is None:
+                nc = os.path.join(directory, "nc")
+                with open(nc, 'w') as nc_file:
+                    nc_file.write(STUB_NC % sys.executable)
+                os.chmod(nc, 0o755)
+                environment['NC_PATH'] = nc
+        write_configuration(settings)
+
+        if options.cache != "cold":
+            subprocess.check_call([sys.executable, NAGCAL, "-f", os.path.join(directory, "nagcal.cfg"),
+                "--sync"], env=environment)
+            if options.cache == "stale":
+                # old enough to be past any fresh TTL, not to be past a stale TTL
+                synced = time.time() - 300
+                for name in os.listdir(directory):
+                    if name.endswith(".cache") or name.endswith(".sqlite") or name.endswith(".records"):
+                        os.utime(os.path.join(directory, name), (synced, synced))
+        if options.serve:
+            daemon = subprocess.Popen([sys.executable, NAGCAL, "-f", os.path.join(directory, "nagcal.cfg"),
+                "--serve"], env=environment)
+            waited = time.time() + 10
+            while not os.path.exists(socket_file):
+                if daemon.poll() is not None or time.time() > waited:
+                    raise RuntimeError("nagcal --serve did not start listening on %s" % socket_file)
+                time.sleep(0.05)
+        server.mode = options.mode
+        before = server.stats()
+
+        # hand out alert numbers to worker threads, each running one alert at a time
+        alerts = iter(range(options.alerts))
+        lock = threading.Lock()
+        results = []
+        def work():
+            """Run alerts until there are none left."""
+            while True:
+                with lock:
+                    number = next(alerts, None)
+                if number is None:
+                    return
+                result = run_alert(number, directory, environment, arguments)
+                with lock:
+                    results.append(result)
+
+        started = time.time()
+        workers = [threading.Thread(target=work) for _ in range(min(concurrency, options.alerts))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - started
+        time.sleep(0.5) # let background syncs started by the storm reach the fake Google
+        after = server.stats()
+
+        recipients = []
+        if os.path.exists(sent):
+            with open(sent) as sent_file:
+                recipients = [line.strip() for line in sent_file]
+    finally:
+        if daemon is not None and daemon.poll() is None:
+            daemon.terminate()
+            daemon.wait()
+        server.shutdown()
+        shutil.rmtree(directory)
+
+    latencies = [seconds for seconds, _ in results]
+    report = {
+            'alerts': options.alerts,
+            'concurrency': concurrency,
+            'mode': options.mode,
+            'cache': options.cache,
+            'snapshot': options.snapshot,
+            'serve': options.serve,
+            'options': options.option,
+            'seconds': elapsed,
+            'alerts_per_second': options.alerts / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': max(latencies) * 1000,
+            'failed': len([status for _, status in results if status != 0]),
+            'mailed': len(recipients),
+            'fallbacks': recipients.count(FALLBACK),
+            'google_requests': dict((kind, after[kind] - before.get(kind, 0))
+                for kind in after if after[kind] != before.get(kind, 0)),
+            }
+    if options.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+        return 0
+    print "%(alerts)d alerts, %(concurrency)d at a time, fake Google %(mode)s, %(cache)s cache" % report
+    if options.snapshot or options.serve:
+        print "answered:   %s, then nagcal --current" % " or ".join(
+            name for name, used in (("snapshot", options.snapshot), ("nagcal --serve", options.serve)) if used)
+    if options.option:
+        print "settings:   %s" % ", ".join(options.option)
+    print "throughput: %.1f alerts/s (%.2f s in all)" % (report['alerts_per_second'], elapsed)
+    print "latency:    p50 %(p50_ms).1f ms  p99 %(p99_ms).1f ms  max %(max_ms).1f ms" % report
+    print "mailed:     %(mailed)d, %(fallbacks)d of them to the fallback address, %(failed)d failed" % report
+    print "Google:     %s" % (report['google_requests'] or "no requests")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
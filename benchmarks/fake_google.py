@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""A local stand-in for the parts of Google that NaGCal talks to, serving synthetic data.
+
+It serves a calendar event feed, a contacts feed and the OAuth 2.0 token
+endpoint over plain HTTP with keep-alive, answering like Google does to the
+queries NaGCal makes: paged feeds with next links, ETags and 304 responses,
+updated-min, start-min/start-max, text queries and gzip compression.
+
+The calendar holds a configurable number of back-to-back shifts around now,
+taken in turn by a configurable number of distinct people, who are all in
+the contacts feed. Requests are counted per feed, and can be read from /stats.
+
+In "slow" mode every response is delayed, and in "down" mode connections are
+closed without a response, to see how NaGCal copes with Google misbehaving.
+
+usage: python benchmarks/fake_google.py [--port PORT] [--shifts N] [--people N] [--mode MODE]
+"""
+import sys
+import gzip
+import json
+import time
+import socket
+import urlparse
+import datetime
+import threading
+import BaseHTTPServer
+import SocketServer
+from StringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+from optparse import OptionParser
+
+CALENDAR_PATH = "/calendar/feeds/bench/private/full"
+CONTACTS_PATH = "/m8/feeds/contacts/default/full"
+TOKEN_PATH = "/o/oauth2/token"
+STATS_PATH = "/stats"
+MODES = ("healthy", "slow", "down")
+UPDATED = "2012-01-01T00:00:00.000Z" # when every event was last changed
+NAMESPACES = "xmlns='http://www.w3.org/2005/Atom' xmlns:gd='http://schemas.google.com/g/2005' " \
+        "xmlns:gContact='http://schemas.google.com/contact/2008' " \
+        "xmlns:openSearch='http://a9.com/-/spec/opensearch/1.1/'"
+
+def rfc3339(when):
+    """Return a naive UTC datetime formatted like Google does."""
+    return when.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+def parse_rfc3339(text):
+    """Return the naive UTC datetime for an RFC 3339 timestamp as sent by NaGCal."""
+    return datetime.datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S")
+
+class FakeGoogle(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server holding the synthetic calendar and contacts, and counting the requests for them."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, shifts=1000, people=50, shift_hours=8, mode="healthy", delay=1.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeGoogleHandler)
+        self.mode = mode
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.counts = {}
+        now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        first = now - datetime.timedelta(hours=shift_hours * (shifts // 2))
+        self.events = []
+        for i in range(shifts):
+            start = first + datetime.timedelta(hours=shift_hours * i)
+            self.events.append(("http://www.google.com/calendar/feeds/bench/events/%d" % i,
+                    "Person %d" % (i % people), start, start + datetime.timedelta(hours=shift_hours)))
+        self.contacts = []
+        for i in range(people):
+            self.contacts.append(("http://www.google.com/m8/feeds/contacts/bench/base/%d" % i,
+                    "Person %d" % i, "person%d@example.com" % i, "+46 70 %07d" % i))
+
+    def url(self, path):
+        """Return the URL of path on this server."""
+        return "http://%s:%d%s" % (self.server_address[0], self.server_address[1], path)
+
+    def count(self, kind):
+        """Count one request of the given kind."""
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def stats(self):
+        """Return a copy of the request counts."""
+        with self.lock:
+            return dict(self.counts)
+
+    def handle_error(self, request, client_address):
+        """Ignore clients that hung up, as when a deadline ran out, and report anything else."""
+        if isinstance(sys.exc_info()[1], socket.error):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class FakeGoogleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer feed and token requests the way Google would."""
+    protocol_version = "HTTP/1.1" # keep connections alive, like Google
+
+    def log_message(self, *args): # pylint: disable=W0221
+        pass
+
+    def do_GET(self): # pylint: disable=C0103
+        url = urlparse.urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in urlparse.parse_qs(url.query).items())
+        if url.path == STATS_PATH:
+            return self.respond(200, json.dumps(self.server.stats()), "application/json")
+        if not self.misbehave():
+            return
+        if url.path == CALENDAR_PATH:
+            self.server.count("calendar")
+            return self.feed(url.path, params, self.calendar_entries(params), self.event_xml)
+        if url.path == CONTACTS_PATH:
+            self.server.count("contacts")
+            return self.feed(url.path, params, self.contacts_entries(params), self.contact_xml)
+        self.respond(404, "Not found", "text/plain")
+
+    def do_POST(self): # pylint: disable=C0103
+        self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        if not self.misbehave():
+            return
+        if urlparse.urlparse(self.path).path != TOKEN_PATH:
+            return self.respond(404, "Not found", "text/plain")
+        self.server.count("token")
+        self.respond(200, json.dumps({'access_token': "bench-%f" % time.time(),
+                'token_type': "Bearer", 'expires_in': 3600}), "application/json")
+
+    def misbehave(self):
+        """Delay or drop the request according to the server's mode, return False if it was dropped."""
+        if self.server.mode == "down":
+            self.server.count("dropped")
+            self.close_connection = 1
+            return False
+        if self.server.mode == "slow":
+            time.sleep(self.server.delay)
+        return True
+
+    def calendar_entries(self, params):
+        """Return the events matching the query parameters."""
+        if params.get('updated-min', "") >= UPDATED:
+            return []
+        events = self.server.events
+        if 'start-min' in params:
+            start_min = parse_rfc3339(params['start-min'])
+            events = [event for event in events if event[3] > start_min]
+        if 'start-max' in params:
+            start_max = parse_rfc3339(params['start-max'])
+            events = [event for event in events if event[2] < start_max]
+        return events
+
+    def contacts_entries(self, params):
+        """Return the contacts matching the query parameters."""
+        contacts = self.server.contacts
+        if 'q' in params:
+            words = params['q'].lower().split()
+            contacts = [contact for contact in contacts
+                    if all(word in ("%s %s" % (contact[1], contact[2])).lower() for word in words)]
+        return contacts
+
+    @staticmethod
+    def event_xml(event):
+        """Return the entry for an (id, title, start, end) event."""
+        event_id, title, start, end = event
+        return "<entry><id>%s</id><title>%s</title><gd:when startTime='%s' endTime='%s'/></entry>" % (
+                escape(event_id), escape(title), rfc3339(start), rfc3339(end))
+
+    @staticmethod
+    def contact_xml(contact):
+        """Return the entry for an (id, name, email, phone) contact."""
+        contact_id, name, email, phone = contact
+        return "<entry><id>%s</id><title>%s</title><gd:name><gd:fullName>%s</gd:fullName></gd:name>" \
+                "<gd:email address=%s primary='true'/>" \
+                "<gd:phoneNumber rel='http://schemas.google.com/g/2005#mobile'>%s</gd:phoneNumber></entry>" % (
+                escape(contact_id), escape(name), escape(name), quoteattr(email), escape(phone))
+
+    def feed(self, path, params, entries, entry_xml):
+        """Respond with one page of entries, or 304 if the client's ETag still matches."""
+        start_index = int(params.pop('start-index', 1))
+        max_results = int(params.get('max-results', 25))
+        # the ETag covers the query and the data, which never changes
+        etag = 'W/"%08x"' % (hash((path, tuple(sorted(params.items())), start_index, len(entries)))
+                & 0xffffffff)
+        if self.headers.getheader('if-none-match') == etag:
+            self.server.count("not_modified")
+            return self.respond(304, "", None, etag)
+        page = entries[start_index - 1:start_index - 1 + max_results]
+        next_link = ""
+        if start_index - 1 + max_results < len(entries):
+            params['start-index'] = start_index + max_results
+            next_link = "<link rel='next' type='application/atom+xml' href=%s/>" % quoteattr(
+                    "%s?%s" % (self.server.url(path), "&".join("%s=%s" % (key, value)
+                        for key, value in sorted(params.items()))))
+        body = "<?xml version='1.0' encoding='UTF-8'?><feed %s gd:etag='%s'><updated>%s</updated>" \
+                "<openSearch:totalResults>%d</openSearch:totalResults>%s%s</feed>" % (
+                NAMESPACES, etag.replace("'", "&apos;"), UPDATED, len(entries), next_link,
+                "".join(entry_xml(entry) for entry in page))
+        self.respond(200, body, "application/atom+xml; charset=UTF-8", etag)
+
+    def respond(self, status, body, content_type, etag=None):
+        """Send a complete response, gzip compressed if the client accepts it."""
+        self.send_response(status)
+        if body and 'gzip' in (self.headers.getheader('accept-encoding') or ""):
+            compressed = StringIO()
+            gzip_file = gzip.GzipFile(fileobj=compressed, mode='wb')
+            gzip_file.write(body)
+            gzip_file.close()
+            body = compressed.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start(port=0, **kwargs):
+    """Start a FakeGoogle on localhost in a background thread and return it. See FakeGoogle for arguments."""
+    server = FakeGoogle(("127.0.0.1", port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--port", type="int", default=8080, help="port to listen on (default 8080)")
+    parser.add_option("--shifts", type="int", default=1000, help="number of shifts (default 1000)")
+    parser.add_option("--people", type="int", default=50, help="number of distinct people (default 50)")
+    parser.add_option("--shift-hours", type="int", default=8, help="length of each shift (default 8)")
+    parser.add_option("--mode", choices=MODES, default="healthy",
+            help="one of %s (default healthy)" % ", ".join(MODES))
+    parser.add_option("--delay", type="float", default=1.0,
+            help="seconds each response is delayed in slow mode (default 1)")
+    options, _ = parser.parse_args()
+    server = FakeGoogle(("127.0.0.1", options.port), shifts=options.shifts, people=options.people,
+            shift_hours=options.shift_hours, mode=options.mode, delay=options.delay)
+    print "calendar_url = %s" % server.url(CALENDAR_PATH)
+    print "contacts_url = %s" % server.url(CONTACTS_PATH)
+    print "token_uri = %s" % server.url(TOKEN_PATH)
+    print "request counts at %s" % server.url(STATS_PATH)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
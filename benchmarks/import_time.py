@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Guard the start-up cost of a lookup answered from the cache.
+
+Runs nagcal --current --email against a fresh cache in a temporary directory,
+several times in new interpreters, and fails if any of the modules that are
+only needed for syncing got imported, or if the median run took longer than
+the budget. CLI start-up is the floor of NaGCal's latency per alert.
+
+usage: python benchmarks/import_time.py [--runs N] [--budget SECONDS]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "scripts", "nagcal")
+# modules a cache hit must not import
+HEAVY_MODULES = ("gdata", "atom", "oauth2client", "httplib2", "gflags", "iso8601",
+        "nagcal.transport", "nagcal.feeds")
+
+# runs the script in this interpreter, then reports what it imported
+CHILD = """
+import sys, json, time
+started = time.time()
+sys.argv = %(argv)r
+sys.path.insert(0, %(root)r)
+try:
+    execfile(%(script)r, {'__name__': '__main__'})
+except SystemExit as exc:
+    if exc.code not in (None, 0):
+        raise
+sys.stdout.flush()
+json.dump({'elapsed': time.time() - started,
+        'modules': sorted(name for name, module in sys.modules.items() if module is not None)}, sys.stderr)
+"""
+
+CONFIGURATION = """[nagcal]
+calendar_url = https://www.google.com/calendar/feeds/example/private/full
+calendar_file = %(directory)s/calendar.cache
+contacts_file = %(directory)s/contacts.cache
+credentials_file = %(directory)s/credentials
+log_file = %(directory)s/nagcal.log
+phone_types = mobile,work
+[oauth]
+user_agent = NaGCal
+display_name = NaGCal
+client_id = client
+client_secret = secret
+"""
+
+def write_fixture(directory):
+    """Write a configuration, credentials and a cache with someone on call now to directory."""
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    hour = datetime.timedelta(hours=1)
+    with open(os.path.join(directory, "nagcal.cfg"), 'w') as config_file:
+        config_file.write(CONFIGURATION % {'directory': directory})
+    with open(os.path.join(directory, "credentials"), 'w') as credentials_file:
+        json.dump({'_module': 'oauth2client.client', '_class': 'OAuth2Credentials',
+                'invalid': False, 'access_token': 'token', 'client_id': 'client',
+                'client_secret': 'secret', 'refresh_token': 'refresh', 'token_expiry': None,
+                'token_uri': 'https://accounts.google.com/o/oauth2/token',
+                'user_agent': 'NaGCal'}, credentials_file)
+    with open(os.path.join(directory, "calendar.cache"), 'w') as calendar_file:
+        calendar_file.write("# generation 1\n%s+00:00\t%s+00:00\tOn Call\tevent\n" % (
+                now - hour, now + hour))
+    with open(os.path.join(directory, "contacts.cache"), 'w') as contacts_file:
+        contacts_file.write("# generation 1\nOn Call\toncall@example.com\t+4612345\t%d\n" % time.time())
+
+def run_once(directory):
+    """Run one lookup in a new interpreter and return (wall seconds, seconds in the script, modules, output)."""
+    child = CHILD % {
+            'argv': [SCRIPT, "-f", os.path.join(directory, "nagcal.cfg"), "--current", "--email"],
+            'root': ROOT,
+            'script': SCRIPT,
+            }
+    started = time.time()
+    process = subprocess.Popen([sys.executable, "-c", child],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, report = process.communicate()
+    wall = time.time() - started
+    if process.returncode != 0:
+        raise RuntimeError("lookup failed:\n%s" % report)
+    report = json.loads(report.strip().splitlines()[-1])
+    return wall, report['elapsed'], report['modules'], output.strip()
+
+def median(values):
+    """Return the median of a non-empty list of numbers."""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--runs", type="int", default=10,
+            help="number of lookups to time (default 10)")
+    parser.add_option("-b", "--budget", type="float", default=0.25,
+            help="maximum median seconds for a lookup, including interpreter start-up (default 0.25)")
+    options, _ = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="nagcal-bench-")
+    try:
+        write_fixture(directory)
+        walls = []
+        in_script = []
+        for _ in range(options.runs):
+            wall, elapsed, modules, output = run_once(directory)
+            walls.append(wall)
+            in_script.append(elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+    heavy = [module for module in modules
+            if any(module == name or module.startswith(name + ".") for name in HEAVY_MODULES)]
+    print "lookup answered: %s" % output
+    print "median wall time: %.1f ms (budget %.1f ms)" % (median(walls) * 1000, options.budget * 1000)
+    print "median time in script: %.1f ms" % (median(in_script) * 1000)
+    print "modules imported: %d" % len(modules)
+    failed = False
+    if output != "oncall@example.com":
+        print "FAIL: unexpected answer"
+        failed = True
+    if heavy:
+        print "FAIL: imported modules only needed for syncing: %s" % ", ".join(heavy)
+        failed = True
+    if median(walls) > options.budget:
+        print "FAIL: lookups are slower than the budget"
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Benchmark syncing and lookups against a local fake Google, without touching the real one.
+
+Starts benchmarks/fake_google.py with a synthetic calendar, then measures, in
+a temporary directory:
+    - a full sync followed by two incremental ones, with ShiftCalendar.sync
+    - lookups of the current person from the cache, with get_current_person
+    - lookups of the current person with the nagcal script, in new processes
+and reports wall times, lookup latency percentiles, peak RSS and the number
+of requests each step made to the fake Google.
+
+usage: python benchmarks/sync_bench.py [--shifts N] [--people N] [--cache-backend BACKEND] [--json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import datetime
+import resource
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, "scripts", "nagcal")
+sys.path.insert(0, ROOT)
+import fake_google # pylint: disable=W0403
+from nagcal import ShiftCalendar
+
+CONFIGURATION = """[nagcal]
+calendar_url = %(calendar_url)s
+contacts_url = %(contacts_url)s
+calendar_file = %(directory)s/calendar.cache
+contacts_file = %(directory)s/contacts.cache
+credentials_file = %(directory)s/credentials
+log_file = %(directory)s/nagcal.log
+phone_types = mobile,work
+cache_backend = %(cache_backend)s
+[oauth]
+user_agent = NaGCal
+display_name = NaGCal
+client_id = client
+client_secret = secret
+"""
+
+def write_credentials(filename, token_uri):
+    """Write credentials whose access token has expired, so the first sync refreshes it at token_uri."""
+    expired = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    with open(filename, 'w') as credentials_file:
+        json.dump({'_module': 'oauth2client.client', '_class': 'OAuth2Credentials',
+                'invalid': False, 'access_token': 'expired', 'client_id': 'client',
+                'client_secret': 'secret', 'refresh_token': 'refresh',
+                'token_expiry': expired.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                'token_uri': token_uri, 'user_agent': 'NaGCal'}, credentials_file)
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of a non-empty list of numbers."""
+    values = sorted(values)
+    return values[max(0, int(round(fraction * len(values))) - 1)]
+
+def latencies(values):
+    """Summarize a list of seconds as milliseconds."""
+    return {'p50_ms': percentile(values, 0.50) * 1000, 'p90_ms': percentile(values, 0.90) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000, 'max_ms': max(values) * 1000}
+
+def requests_made(server, before):
+    """Return the requests server counted since the counts in before."""
+    after = server.stats()
+    return dict((kind, after[kind] - before.get(kind, 0))
+            for kind in after if after[kind] != before.get(kind, 0))
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--shifts", type="int", default=1000, help="number of shifts (default 1000)")
+    parser.add_option("--people", type="int", default=50, help="number of distinct people (default 50)")
+    parser.add_option("--mode", choices=fake_google.MODES, default="healthy",
+            help="how the fake Google behaves, one of %s (default healthy)" % ", ".join(fake_google.MODES))
+    parser.add_option("--cache-backend", default="text", help="cache backend to use (default text)")
+    parser.add_option("--lookups", type="int", default=200,
+            help="number of in-process lookups (default 200)")
+    parser.add_option("--cli-lookups", type="int", default=20,
+            help="number of lookups with the nagcal script (default 20)")
+    parser.add_option("--json", action="store_true", default=False, help="print the report as JSON")
+    options, _ = parser.parse_args()
+
+    server = fake_google.start(shifts=options.shifts, people=options.people, mode=options.mode, delay=2)
+    directory = tempfile.mkdtemp(prefix="nagcal-bench-")
+    logging.basicConfig(filename=os.path.join(directory, "nagcal.log"))
+    settings = {
+            'calendar_url': server.url(fake_google.CALENDAR_PATH),
+            'contacts_url': server.url(fake_google.CONTACTS_PATH),
+            'cache_backend': options.cache_backend,
+            'directory': directory,
+            }
+    report = {'shifts': options.shifts, 'people': options.people, 'mode': options.mode,
+            'cache_backend': options.cache_backend}
+    try:
+        write_credentials(os.path.join(directory, "credentials"),
+                server.url(fake_google.TOKEN_PATH))
+        with open(os.path.join(directory, "nagcal.cfg"), 'w') as config_file:
+            config_file.write(CONFIGURATION % settings)
+
+        def shift_calendar(**kwargs):
+            """Return a ShiftCalendar using the benchmark's files and the fake Google."""
+            return ShiftCalendar(settings['calendar_url'],
+                    os.path.join(directory, "calendar.cache"),
+                    os.path.join(directory, "contacts.cache"),
+                    {'credentials_file': os.path.join(directory, "credentials"),
+                        'client_id': 'client', 'client_secret': 'secret', 'user_agent': 'NaGCal'},
+                    contacts_url=settings['contacts_url'],
+                    cache_backend=options.cache_backend, **kwargs)
+
+        for name in ("full_sync", "incremental_sync", "unchanged_sync"):
+            before = server.stats()
+            started = time.time()
+            count = shift_calendar(cache_fresh_ttl=0, sync_wait=0).sync(wait=True)
+            report[name] = {'seconds': time.time() - started, 'shifts': count,
+                    'requests': requests_made(server, before)}
+
+        before = server.stats()
+        times = []
+        for _ in range(options.lookups):
+            started = time.time()
+            person = shift_calendar().get_current_person()
+            times.append(time.time() - started)
+        report['lookup'] = latencies(times)
+        report['lookup']['person'] = repr(person)
+        report['lookup']['requests'] = requests_made(server, before)
+
+        before = server.stats()
+        times = []
+        for _ in range(options.cli_lookups):
+            started = time.time()
+            process = subprocess.Popen([sys.executable, SCRIPT, "-f",
+                os.path.join(directory, "nagcal.cfg"), "--current", "--email"],
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                env=dict(os.environ, PYTHONPATH=ROOT))
+            output = process.communicate()[0] # an error message if there is no cache to answer from
+            times.append(time.time() - started)
+        report['cli_lookup'] = latencies(times)
+        report['cli_lookup']['output'] = output.strip()
+        report['cli_lookup']['requests'] = requests_made(server, before)
+
+        # ru_maxrss is in kilobytes on Linux
+        report['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        report['cli_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        report['requests'] = server.stats()
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+    if options.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+        return 0
+    print "%(shifts)d shifts, %(people)d people, fake Google %(mode)s, %(cache_backend)s cache" % report
+    for name in ("full_sync", "incremental_sync", "unchanged_sync"):
+        print "%-17s %8.1f ms  %5s shifts  requests %s" % (name.replace("_", " ") + ":",
+                report[name]['seconds'] * 1000, report[name]['shifts'], report[name]['requests'])
+    for name in ("lookup", "cli_lookup"):
+        print "%-17s p50 %.2f ms  p90 %.2f ms  p99 %.2f ms  max %.2f ms  requests %s" % (
+                name.replace("_", " ") + ":", report[name]['p50_ms'], report[name]['p90_ms'],
+                report[name]['p99_ms'], report[name]['max_ms'], report[name]['requests'])
+    print "current person:   %s (script: %s)" % (report['lookup']['person'], report['cli_lookup']['output'])
+    print "peak RSS:         %d kB (script %d kB)" % (report['peak_rss_kb'], report['cli_peak_rss_kb'])
+    print "requests in all:  %s" % report['requests']
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
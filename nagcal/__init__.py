@@ -1,28 +1,47 @@
-"""A way to keep on-call schedules in Google Calendar and resolve email/phone number to current person on call from Google Contacts."""
+"""A way to keep on-call schedules in Google Calendar and resolve email/phone number to current person on call from Google Contacts.
+
+Only the standard library is imported up front. gdata, oauth2client, httplib2,
+gflags and iso8601 are imported where they are needed, which is when syncing
+or setting up credentials, so that a lookup answered from the cache starts quickly.
+"""
 import os
+import re
 import sys
+import json
+import errno
+import fcntl
+import math
 import time
-import gflags
+import Queue
+import heapq
+import bisect
+import calendar
+import tempfile
+import threading
 import logging
-import httplib2
 import datetime
-import gdata.data
-import gdata.gauth
-import gdata.acl.data
-import oauth2client.tools
-import gdata.contacts.data
-import gdata.calendar.data
-import gdata.contacts.client
-import gdata.calendar.client
-from iso8601 import parse_date # pylint: disable=E0611
 from operator import attrgetter
-from oauth2client.file import Storage
-from oauth2client.client import OAuth2WebServerFlow
+from nagcal.cache import open_cache
+from nagcal.metrics import Metrics
+
+RFC3339_FORMAT = "%Y-%m-%dT%H:%M:%SZ" # for UTC datetimes in Google Data API queries
+# datetimes as written to the cache by str(), e.g. 2012-01-02 08:00:00+00:00
+CACHED_DATETIME = re.compile(r"(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?"
+        r"(?:Z|([+-])(\d\d):?(\d\d))$")
 
 class ShiftCalendar:
     """ShiftCalendar interfaces with Google Data APIs to sync one calendar and multiple contacts."""
     default_scope = "https://www.google.com/calendar/feeds/ https://www.google.com/m8/feeds"
     default_phone_type_preference = ["mobile", "work"]
+    default_contacts_concurrency = 4
+    contacts_page_size = 500
+    calendar_page_size = 250
+    default_contacts_ttl = 86400 # seconds during which cached contacts are used without asking Google
+    default_full_sync_interval = 86400 # seconds between syncs that download the whole calendar
+    default_sync_wait = 10 # seconds to wait for another process to finish syncing
+    default_cache_fresh_ttl = 60 # seconds during which the cache is used instead of syncing
+    default_circuit_threshold = 3 # failed syncs in a row after which Google is not asked for a while
+    default_circuit_reset = 300 # seconds after which Google is asked again, once the circuit is open
 
     def __init__(self, calendar_url, calendar_file, contacts_file, oauth_settings, **kwargs):
         """Initialize a new ShiftCalendar
@@ -38,39 +57,98 @@ class ShiftCalendar:
             'client_id': app ID from Google's API Console
             'client_secret': app secret from Google's API console
             'scope': (optional) scope for which to request access from Google
+
+        Keyword arguments:
+        phone_type_preference -- list of phone number types to pick from, most preferred last
+        snapshot_file -- path to file where the current person is written after each sync
+        contacts_concurrency -- maximum number of contacts pages downloaded at the same time during sync
+        contacts_ttl -- seconds during which a cached contact is used without looking it up again
+        state_file -- path to file where sync state is kept, defaults to calendar_file + ".state"
+        full_sync_interval -- seconds between full syncs, incremental syncs are done in between
+        lookback -- days of past shifts to sync, all of them if not given
+        lookahead -- days of future shifts to sync, all of them if not given
+        sync_wait -- seconds to wait for another process that is syncing, before using the cache
+        cache_fresh_ttl -- seconds during which the cache is used without syncing
+        cache_stale_ttl -- seconds during which the cache is used while syncing in the background,
+                           defaults to cache_fresh_ttl (never sync in the background)
+        circuit_threshold -- failed syncs in a row after which syncing is skipped for circuit_reset seconds
+        circuit_reset -- seconds to use the cache without syncing after circuit_threshold failed syncs
+        deadline -- seconds a sync may take, including waiting for another process to sync
+        cache_backend -- how shifts and people are cached, "text" (default) or "sqlite",
+                         see nagcal.cache
+        contacts_url -- URL of the contacts feed, defaults to the user's contacts on Google
+        metrics -- nagcal.metrics.Metrics to time phases and count events in, see nagcal.metrics
         """
         self.calendar_url = calendar_url
-        self.cache_files = { 'calendar': calendar_file, 'contacts': contacts_file }
-        # make sure cache files are present and at least readable
-        for filename in self.cache_files.values():
-            try:
-                cache_file = open(filename, 'r')
-            except IOError:
-                cache_file = open(filename, 'w')
-            finally:
-                cache_file.close()
+        self.cache_settings = (kwargs.get('cache_backend', 'text'), calendar_file, contacts_file)
+        self.cache = open_cache(*self.cache_settings)
         if 'scope' not in oauth_settings:
             oauth_settings['scope'] = ShiftCalendar.default_scope
         if 'phone_type_preference' not in kwargs:
             self.phone_type_preference = ShiftCalendar.default_phone_type_preference
         else:
             self.phone_type_preference = kwargs['phone_type_preference']
+        self.snapshot_file = kwargs.get('snapshot_file')
+        self.contacts_concurrency = kwargs.get('contacts_concurrency',
+                ShiftCalendar.default_contacts_concurrency)
+        self.contacts_ttl = kwargs.get('contacts_ttl', ShiftCalendar.default_contacts_ttl)
+        self.state_file = kwargs.get('state_file', calendar_file + ".state")
+        self.full_sync_interval = kwargs.get('full_sync_interval',
+                ShiftCalendar.default_full_sync_interval)
+        self.lookback = kwargs.get('lookback')
+        self.lookahead = kwargs.get('lookahead')
+        self.sync_wait = kwargs.get('sync_wait', ShiftCalendar.default_sync_wait)
+        self.cache_fresh_ttl = kwargs.get('cache_fresh_ttl', ShiftCalendar.default_cache_fresh_ttl)
+        self.cache_stale_ttl = max(self.cache_fresh_ttl,
+                kwargs.get('cache_stale_ttl', self.cache_fresh_ttl))
+        self.circuit_threshold = kwargs.get('circuit_threshold',
+                ShiftCalendar.default_circuit_threshold)
+        self.circuit_reset = kwargs.get('circuit_reset', ShiftCalendar.default_circuit_reset)
+        self.deadline = kwargs.get('deadline')
+        self.contacts_url = kwargs.get('contacts_url')
+        self.metrics = kwargs.get('metrics') or Metrics()
         self.oauth = oauth_settings
         self.oauth['token'] = None
-        self.oauth['credentials'] = Storage(oauth_settings['credentials_file']).get()
+        self.oauth['credentials'] = None # see get_credentials
         self.have_synced = False
         self.shifts = None
+        self.index = None
         self.people = {}
+        self.directory = None
+        self.http = None
+        self.http_client = None
+        self.clients = {}
 
     def credentials_ok(self):
-        """Return True if stored OAuth credentials are present and valid, False otherwise."""
-        if self.oauth['credentials'] is None or \
-                self.oauth['credentials'].invalid == True:
+        """Return True if stored OAuth credentials are present and valid, False otherwise.
+
+        Unless they were already loaded, the credentials file is only read as JSON,
+        so a lookup answered from the cache does not need to import oauth2client."""
+        if self.oauth['credentials'] is not None:
+            return not self.oauth['credentials'].invalid
+        try:
+            credentials_file = open(self.oauth['credentials_file'], 'r')
+            try:
+                stored = json.load(credentials_file)
+            finally:
+                credentials_file.close()
+        except (IOError, ValueError):
             return False
-        return True
+        return isinstance(stored, dict) and not stored.get('invalid', False)
+
+    def get_credentials(self):
+        """Return the OAuth credentials from credentials_file, loading them on first use."""
+        if self.oauth['credentials'] is None:
+            from oauth2client.file import Storage
+            self.oauth['credentials'] = Storage(self.oauth['credentials_file']).get()
+        return self.oauth['credentials']
 
     def setup_credentials(self):
         """Run interactive OAuth 2.0 setup dance and return True on success, False otherwise."""
+        import gflags
+        import oauth2client.tools
+        from oauth2client.file import Storage
+        from oauth2client.client import OAuth2WebServerFlow
         gflags.FLAGS.auth_local_webserver = False
         storage = Storage(self.oauth['credentials_file'])
         flow = OAuth2WebServerFlow(
@@ -84,8 +162,9 @@ class ShiftCalendar:
 
     def get_token(self):
         """Return a OAuth2Token that can be used with gdata client objects."""
-        if self.oauth['credentials'].access_token_expired:
-            self.oauth['credentials']._refresh(httplib2.Http().request)
+        import gdata.gauth
+        if self.get_credentials().access_token_expired:
+            self.refresh_credentials()
             self.oauth['token'] = None # need a new token after refreshing
         if self.oauth['token'] is None:
             self.oauth['token'] = gdata.gauth.OAuth2Token(
@@ -97,32 +176,110 @@ class ShiftCalendar:
                     refresh_token = self.oauth['credentials'].refresh_token)
         return self.oauth['token']
 
+    def refresh_credentials(self):
+        """Refresh the OAuth access token and persist it to credentials_file, unless another process just did.
+
+        Refreshes are serialized between processes with a lock file next to
+        credentials_file, so when many processes find the token expired at once,
+        one asks Google and the others pick up the token it stored.
+
+        Within a sync with a deadline, waiting for the lock and the refresh
+        request itself both time out at the deadline."""
+        from oauth2client.file import Storage
+        from nagcal.transport import DeadlineExceeded
+        with self.metrics.span('token_refresh'):
+            timeout = None
+            if self.get_http_client().deadline is not None:
+                timeout = self.get_http_client().time_left()
+            lock = FileLock(self.oauth['credentials_file'] + ".lock")
+            if not lock.acquire(timeout):
+                raise DeadlineExceeded("deadline exceeded waiting for another process to refresh the token")
+            try:
+                stored = Storage(self.oauth['credentials_file']).get()
+                if stored is not None and not stored.invalid and \
+                        not stored.access_token_expired:
+                    self.oauth['credentials'] = stored
+                    return
+                credentials = self.get_credentials()
+                credentials.set_store(None) # stored below, atomically
+                http = self.get_http()
+                if timeout is not None:
+                    http.timeout = self.get_http_client().time_left()
+                    for connection in http.connections.values():
+                        if connection.sock is not None:
+                            connection.sock.settimeout(http.timeout)
+                self.metrics.count('api_calls')
+                credentials._refresh(http.request) # pylint: disable=W0212
+                write_atomically(self.oauth['credentials_file'], credentials.to_json())
+            finally:
+                lock.release()
+
+    def get_http(self):
+        """Return the httplib2.Http object used for OAuth requests, which keeps its connections alive."""
+        if self.http is None:
+            import httplib2
+            self.http = httplib2.Http()
+        return self.http
+
+    def get_http_client(self):
+        """Return the PersistentHttpClient shared by all gdata clients of this instance."""
+        if self.http_client is None:
+            from nagcal.transport import PersistentHttpClient
+            self.http_client = PersistentHttpClient()
+        return self.http_client
+
     def get_contacts_client(self):
         """Return an authenticated gdata.contacts.client.ContactsClient object."""
-        client = gdata.contacts.client.ContactsClient(
-                source=self.oauth['user_agent'])
+        if 'contacts' not in self.clients:
+            import gdata.contacts.client
+            self.clients['contacts'] = gdata.contacts.client.ContactsClient(
+                    source=self.oauth['user_agent'])
+            self.clients['contacts'].http_client = self.get_http_client()
+            if self.contacts_url: # the client forces https by default
+                self.clients['contacts'].ssl = self.contacts_url.startswith("https:")
+        client = self.clients['contacts']
         client.auth_token = self.get_token()
         return client
 
     def get_calendar_client(self):
         """Return an authenticated gdata.calendar.client.CalendarClient object."""
-        client = gdata.calendar.client.CalendarClient(
-                source=self.oauth['user_agent'])
+        if 'calendar' not in self.clients:
+            import gdata.calendar.client
+            self.clients['calendar'] = gdata.calendar.client.CalendarClient(
+                    source=self.oauth['user_agent'])
+            self.clients['calendar'].http_client = self.get_http_client()
+        client = self.clients['calendar']
         client.auth_token = self.get_token()
         return client
 
     def cache_age(self):
         """Returns age of oldest cache in seconds"""
         oldest = 0
-        for filename in self.cache_files.values():
+        for filename in self.cache.files:
             age = time.time() - os.path.getmtime(filename)
             if age > oldest:
                 oldest = age
         return oldest
 
-    def sync(self):
+    def load_cache(self):
+        """Read shifts and contacts from the on-disk cache, replacing whatever is in memory."""
+        with self.metrics.span('cache_read'):
+            shifts, people = self.cache.load()
+        self.index = ShiftIndex(shifts)
+        self.shifts = self.index.shifts
+        for contact in people:
+            self.people[contact.query] = contact
+
+    def sync(self, wait=False):
         """Download calendar and look up all contacts found in the calendar.
 
+        A cache younger than cache_fresh_ttl is used as is. A cache younger than
+        cache_stale_ttl is used as well, while a background process syncs it,
+        unless wait is True. A cache that no sync has written to yet, such as
+        one just created for a new cache_backend, is never used without trying
+        to sync first. An indexed cache is not read until it is needed, and then
+        only for what is needed.
+
         Returns:
             number of shifts discovered on first run, True on subsequent runs."""
         if self.have_synced: # only sync once per instance
@@ -131,107 +288,563 @@ class ShiftCalendar:
         use_cache = False
         try:
             cache_age = self.cache_age()
-            if cache_age < 60:
+            if self.cache_empty():
+                logging.warning("Won't use cache because no sync has written to it yet")
+            elif cache_age < self.cache_fresh_ttl:
                 use_cache = True
                 logging.warning("Using cache because cache was modified only %ds ago", cache_age)
-        except IOError as exc:
+            elif cache_age < self.cache_stale_ttl and not wait:
+                use_cache = True
+                logging.warning("Using cache modified %ds ago while syncing in the background", cache_age)
+                self.sync_in_background()
+            self.metrics.count('cache_hits' if use_cache else 'cache_misses')
+        except (IOError, OSError) as exc:
             use_cache = False
+            self.metrics.count('cache_misses')
             logging.warning("Won't use cache due to exception when reading: %s", exc)
 
         if not use_cache:
+            use_cache = not self.sync_once()
+            if use_cache:
+                self.metrics.count('fallbacks')
+        self.have_synced = True
+        if use_cache:
+            if self.cache.indexed:
+                self.shifts = self.index = None # see get_index
+                self.people = {}
+                with self.metrics.span('cache_read'):
+                    return self.cache.count()
+            self.load_cache()
+        elif self.snapshot_file is not None:
+            self.write_snapshot()
+        return len(self.shifts)
+
+    def sync_once(self):
+        """Sync from Google and write the result to the cache, unless another process is already doing so.
+
+        If another process holds the sync lock, wait at most sync_wait seconds for
+        it to finish, after which the caller should read its result from the cache.
+
+        Syncing is skipped while the circuit is open, see circuit_open(). When
+        deadline is set, the whole sync, including the wait, is cut short after
+        that many seconds.
+
+        Returns:
+            True if shifts and people were synced by this process, False if they
+            should be read from the cache."""
+        started = time.time()
+        if self.circuit_open(self.load_state()):
+            logging.warning("Using cache because the last %d syncs failed", self.circuit_threshold)
+            return False
+        lock = FileLock(self.state_file + ".lock")
+        if not lock.acquire(0):
+            sync_wait = self.sync_wait
+            if self.deadline is not None:
+                sync_wait = min(sync_wait, self.deadline)
+            logging.warning("Another process is syncing, waiting up to %ds for it to finish", sync_wait)
+            if lock.acquire(sync_wait):
+                lock.release()
+            return False
+        try:
+            cache_age = self.cache_age()
+            if cache_age < self.cache_fresh_ttl and not self.cache_empty():
+                logging.warning("Using cache because another process synced only %ds ago", cache_age)
+                return False
+
+            state = self.load_state()
+            if self.circuit_open(state): # opened while waiting for the lock
+                return False
+            if state.get('failures', 0) >= self.circuit_threshold:
+                # half open: let this sync probe Google while others keep using the cache
+                logging.warning("Trying to sync again after %d failed syncs", state['failures'])
+                state['circuit_opened'] = int(time.time())
+                self.save_state(state)
+
+            if self.deadline is not None:
+                self.get_http_client().deadline = started + self.deadline
             try:
-                client = self.get_calendar_client()
-                shifts = []
-                event_feed = client.GetCalendarEventFeed(uri=self.calendar_url)
-                for event in event_feed.entry:
-                    shifts.append(
-                            Shift(
-                                event.title.text.encode("utf-8"),
-                                parse_date(event.when[0].start),
-                                parse_date(event.when[0].end)
-                            ))
-                    # download contact info the first time we see this title,
-                    # otherwise person will be grabbed from self.people
-                    self.get_person(event.title.text.encode("utf-8"))
+                shifts, state, modified = self.download()
             except Exception as exc: # pylint: disable=W0703
                 # We don't really care what happened, we just know we can't trust
                 # whatever we managed to sync from Google.
-                use_cache = True
                 logging.error("Exception when syncing: %s", exc)
+                self.record_failure()
+                return False
+            finally:
+                self.get_http_client().deadline = None
+            state.pop('failures', None)
+            state.pop('circuit_opened', None)
 
-        if use_cache:
-            calendar_file = open(self.cache_files['calendar'], 'r')
-            self.shifts = []
-            for line in calendar_file:
-                self.shifts.append(Shift.loads(line))
-            calendar_file.close()
-
-            contacts_file = open(self.cache_files['contacts'], 'r')
-            for line in contacts_file:
-                contact = Person.loads(line)
-                self.people[contact.query] = contact
-            contacts_file.close()
-        else: # we have synced successfully, so cache to disk
-            # sort shifts according to start date (feed order not guaranteed)
-            self.shifts = sorted(shifts, key=attrgetter('start'))
-
-            # persist synced calendar to disk cache
-            calendar_file = open(self.cache_files['calendar'], 'w')
+            # the index keeps shifts sorted by start date (feed order not guaranteed)
+            self.index = ShiftIndex(shifts)
+            self.shifts = self.index.shifts
+
+            if modified:
+                # persist synced contacts and calendar to disk cache as one
+                # generation, so readers never see a partially written cache
+                generation = state.get('generation', 0) + 1
+                state['generation'] = generation
+                with self.metrics.span('cache_write'):
+                    self.cache.save(generation, self.shifts, self.people.values())
+            else: # the cache is as fresh as Google, just tell cache_age()
+                with self.metrics.span('cache_write'):
+                    self.cache.touch()
+
+            self.save_state(state)
+            return True
+        finally:
+            lock.release()
+
+    def circuit_open(self, state):
+        """Return True if the last circuit_threshold syncs failed less than circuit_reset seconds ago.
+
+        While the circuit is open, lookups use the cache right away instead of
+        waiting for Google to time out again."""
+        return state.get('failures', 0) >= self.circuit_threshold and \
+                time.time() - state.get('circuit_opened', 0) < self.circuit_reset
+
+    def record_failure(self):
+        """Count a failed sync in the sync state, opening the circuit after circuit_threshold of them.
+
+        The caller must hold the sync lock, as syncs rewrite the whole state."""
+        self.metrics.count('sync_failures')
+        state = self.load_state()
+        state['failures'] = state.get('failures', 0) + 1
+        if state['failures'] >= self.circuit_threshold:
+            logging.error("Not syncing for %ds after %d failed syncs", self.circuit_reset, state['failures'])
+            state['circuit_opened'] = int(time.time())
+        self.save_state(state)
+
+    def sync_in_background(self):
+        """Start a detached process that syncs to the cache, and return without waiting for it.
+
+        The process is forked twice so that it is not left as a zombie, and its
+        standard streams are closed so that a caller reading our output, such as
+        a shell command substitution, does not wait for it either."""
+        pid = os.fork()
+        if pid != 0:
+            os.waitpid(pid, 0)
+            return
+        try:
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0) # pylint: disable=W0212
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for stream in (sys.stdin, sys.stdout, sys.stderr):
+                os.dup2(devnull, stream.fileno())
+            self.sync_wait = 0 # leave it to a sync that is already running
+            self.metrics.reset(action="background_sync") # a run of its own
+            # neither the cache nor kept-alive connections are shared with the
+            # parent, which may go on using its own, e.g. under --serve
+            self.cache = open_cache(*self.cache_settings)
+            self.http = self.http_client = None
+            self.clients = {}
+            if self.sync_once() and self.snapshot_file is not None:
+                self.write_snapshot()
+            self.metrics.export()
+        except Exception as exc: # pylint: disable=W0703
+            logging.error("Exception when syncing in the background: %s", exc)
+        finally:
+            logging.shutdown()
+            os._exit(0) # pylint: disable=W0212
+
+    def download(self):
+        """Download shifts from Google Calendar and contacts for their titles from Google Contacts.
+
+        If the last full sync was less than full_sync_interval seconds ago and the
+        cache still holds what the last sync wrote, only events updated since the
+        previous sync are requested, including deleted ones, and merged into the
+        cached shifts. Contacts are then only looked up for titles that are new
+        or no longer fresh.
+
+        Feeds are requested conditionally on the ETags from the previous sync, so
+        if nothing changed, nothing is downloaded or parsed. This is only done
+        while the cache holds what that sync wrote.
+
+        Returns:
+            a list of Shifts, the sync state to save once they are cached and
+            whether they differ from what is already cached."""
+        import gdata.client
+        import gdata.calendar.client
+        from nagcal.feeds import CALENDAR_FIELDS
+        state = self.load_state()
+        if not self.cache_matches(state):
+            # whatever the last sync recorded describes a cache that is gone, e.g.
+            # deleted or left behind by another cache_backend, so start over
+            logging.warning("Cache does not hold what the last sync wrote, syncing in full")
+            state.pop('updated_min', None)
+            # the ETags were recorded with that cache, a 304 would "reload" this one
+            state.pop('calendar_etag', None)
+            state.pop('contacts_etag', None)
+        query = gdata.calendar.client.CalendarEventQuery(
+                max_results=ShiftCalendar.calendar_page_size,
+                fields=CALENDAR_FIELDS)
+        shifts = {} # event id -> Shift
+        incremental = 'updated_min' in state and \
+                time.time() - state.get('full_sync', 0) < self.full_sync_interval
+        if incremental:
+            self.load_cache()
             for shift in self.shifts:
-                calendar_file.write("%s\n" % (shift.dumps()))
-            calendar_file.close()
+                if shift.event_id is None: # cached before event ids were
+                    incremental = False
+                    break
+                shifts[shift.event_id] = shift
+        window_start, window_end = self.get_window()
+        if incremental:
+            # no time window here, or events moved out of it would go unnoticed
+            query.updated_min = state['updated_min']
+            query.showdeleted = 'true'
+        else:
+            shifts = {}
+            self.people = {}
+            if window_start is not None:
+                query.start_min = window_start.strftime(RFC3339_FORMAT)
+            if window_end is not None:
+                query.start_max = window_end.strftime(RFC3339_FORMAT)
 
-            # persist synced contacts to disk cache
-            contacts_file = open(self.cache_files['contacts'], 'w')
-            for person in self.people.values():
-                contacts_file.write("%s\n" % (person.dumps()))
-            contacts_file.close()
+        # only ask whether the calendar changed if asking the same as last time
+        fingerprint = [self.calendar_url, query.updated_min, query.start_min, query.start_max]
+        etag = None
+        if state.get('calendar_query') == fingerprint:
+            etag = state.get('calendar_etag')
+        state['calendar_query'] = fingerprint
+        state.pop('calendar_etag', None)
 
-        self.have_synced = True
-        return len(self.shifts)
+        # pages are turned into Shifts and dropped as they arrive, while the
+        # next page is being downloaded
+        modified = True
+        updated = None
+        events = pages = 0
+        try:
+            for event_feed in prefetch(self.get_event_pages(query, etag)):
+                if pages == 0:
+                    updated = event_feed.updated
+                    state['calendar_etag'] = event_feed.etag
+                pages += 1
+                for event_id, title, start, end, canceled in event_feed.entries:
+                    if canceled:
+                        shifts.pop(event_id, None)
+                    else:
+                        shifts[event_id] = Shift(title, start, end, event_id)
+                events += len(event_feed.entries)
+            logging.info("Synced %d events %s", events,
+                    "incrementally" if incremental else "in full")
+            if pages > 1: # the ETag only covers the first page
+                state.pop('calendar_etag', None)
+            if updated is None: # can't tell what the next sync may skip
+                state.pop('updated_min', None)
+        except gdata.client.NotModified:
+            logging.info("Calendar not modified since last sync")
+            modified = False
+            state['calendar_etag'] = etag
+            if not incremental:
+                self.load_cache()
+            shifts = dict((shift.event_id, shift) for shift in self.shifts)
+        for event_id, shift in shifts.items():
+            if (window_start is not None and shift.end <= window_start) or \
+                    (window_end is not None and shift.start >= window_end):
+                modified = True
+                del shifts[event_id]
+
+        # download all contacts once and look up each distinct new or stale title in them
+        titles = set(shift.title for shift in shifts.values())
+        stale = [title for title in titles if title not in self.people or
+                not self.people[title].is_fresh(self.contacts_ttl)]
+        if stale:
+            modified = True
+            self.refresh_people(stale, state)
+        self.people = dict((title, self.people[title]) for title in titles)
+
+        if updated is not None:
+            # the server's idea of now, so clock skew can't make us miss updates
+            state['updated_min'] = updated
+        if not incremental:
+            state['full_sync'] = int(time.time())
+        return shifts.values(), state, modified
+
+    def cache_empty(self):
+        """Return True if no sync has saved to the cache, or it holds no shifts, whatever its age."""
+        with self.metrics.span('cache_read'):
+            return self.cache.generation() is None or self.cache.count() == 0
+
+    def cache_matches(self, state):
+        """Return True if the cache holds shifts and is of the generation the sync state was saved with."""
+        with self.metrics.span('cache_read'):
+            return self.cache.generation() == state.get('generation') and self.cache.count() > 0
+
+    def refresh_people(self, queries, state):
+        """Look up the given text queries like get_people, asking Google only if contacts changed since last time.
+
+        If every query is already cached, the contacts feed is requested conditionally
+        on the ETag kept in state, and if it has not changed the cached Person objects
+        are just marked as fetched now."""
+        import gdata.client
+        etag = None
+        if all(query in self.people for query in queries):
+            etag = state.get('contacts_etag')
+        try:
+            self.get_people(queries, etag)
+            state['contacts_etag'] = self.directory.etag
+        except gdata.client.NotModified:
+            logging.info("Contacts not modified since last sync")
+            for query in queries:
+                self.people[query].fetched = int(time.time())
+
+    def get_event_pages(self, query, etag = None):
+        """Generate the pages of the calendar event feed for a query as FeedPages, following next links.
+
+        If etag is given and the first page has not changed since, gdata.client.NotModified is raised."""
+        from nagcal.feeds import parse_event_feed
+        client = self.get_calendar_client()
+        self.metrics.count('api_calls')
+        with self.metrics.span('calendar_fetch'):
+            body = client.GetFeed(self.calendar_url,
+                    converter=read_body, q=query, http_request=conditional_request(etag))
+        with self.metrics.span('feed_parse'):
+            event_feed = parse_event_feed(body)
+        while event_feed is not None:
+            yield event_feed
+            next_url = event_feed.next_url
+            event_feed = body = None # let the page be freed while fetching the next
+            if next_url is not None:
+                self.metrics.count('api_calls')
+                with self.metrics.span('calendar_fetch'):
+                    body = client.GetFeed(next_url, converter=read_body)
+                with self.metrics.span('feed_parse'):
+                    event_feed = parse_event_feed(body)
+
+    def get_window(self):
+        """Return the (start, end) datetimes of the part of the calendar that is synced.
+
+        The window is widened to whole days in UTC. Either end is None if the
+        window is unbounded in that direction."""
+        # whole days, so the window and thus the query only change daily
+        today = datetime.datetime.now(UTC()).replace(hour=0, minute=0, second=0, microsecond=0)
+        window_start = window_end = None
+        if self.lookback is not None:
+            window_start = today - datetime.timedelta(days=math.ceil(self.lookback))
+        if self.lookahead is not None:
+            window_end = today + datetime.timedelta(days=math.ceil(self.lookahead) + 1)
+        return window_start, window_end
+
+    def load_state(self):
+        """Return the dictionary last saved with save_state, or an empty one."""
+        try:
+            state_file = open(self.state_file, 'r')
+            try:
+                return json.load(state_file)
+            finally:
+                state_file.close()
+        except (IOError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        """Persist a dictionary of sync state, such as when the calendar was last synced."""
+        write_atomically(self.state_file, json.dumps(state))
+
+    def write_snapshot(self):
+        """Write the current person and the window during which they are on call to the snapshot file.
+
+        The snapshot is a single tab separated line that is cheap to read, even from a shell:
+        valid_from, valid_until (both seconds since the epoch), email, phone and query."""
+        current_shift = self.get_current_shift()
+        if current_shift is None or current_shift.title not in self.people:
+            if os.path.exists(self.snapshot_file):
+                os.unlink(self.snapshot_file)
+            return
+        # the window is bounded by handovers rather than the shift itself,
+        # as overlapping shifts may cut it short at either end
+        now = datetime.datetime.now(UTC())
+        person = self.people[current_shift.title]
+        with self.metrics.span('cache_write'):
+            write_atomically(self.snapshot_file, "%d\t%d\t%s\t%s\t%s\n" % (
+                    calendar.timegm(self.index.previous_handover(now).utctimetuple()),
+                    calendar.timegm(self.index.next_handover(now).utctimetuple()),
+                    person.email, person.phone, person.query))
+
+    def read_snapshot(self):
+        """Return the Person in the snapshot file if it is still on call, None otherwise."""
+        try:
+            snapshot_file = open(self.snapshot_file, 'r')
+            try:
+                fields = snapshot_file.readline().rstrip("\n").split("\t")
+            finally:
+                snapshot_file.close()
+        except IOError:
+            return None
+        if len(fields) != 5:
+            return None
+        if not int(fields[0]) <= time.time() < int(fields[1]):
+            return None
+        return Person(fields[4], fields[2], fields[3])
 
     def get_person(self, query):
-        """Given a text query, fetch and return a Person object. Caches results per query."""
+        """Given a text query, fetch and return a Person object. Caches results per query.
+
+        During sync, the query is resolved against the contacts directory that was
+        downloaded. Otherwise a cached Person is returned as is, also when it was
+        fetched more than contacts_ttl seconds ago, as the next sync refreshes it
+        and a lookup should not wait for Google. Only a query that is not cached
+        at all is searched for on Google Contacts, within deadline and unless the
+        circuit is open, see circuit_open(). Returns None if that search fails."""
+        if query not in self.people and self.index is None and self.have_synced:
+            with self.metrics.span('cache_read'):
+                cached = self.cache.person(query) # not loaded, see get_index
+            if cached is not None:
+                self.people[query] = cached
         if query in self.people:
             person = self.people[query]
+            if self.directory is None:
+                if not person.is_fresh(self.contacts_ttl):
+                    logging.warning("Using contact cached for '%s' until a sync refreshes it", query)
+                return person
         else:
             person = Person(query)
-        client = self.get_contacts_client()
-        person.update(client, phone_type_preference=self.phone_type_preference)
+        if self.directory is not None:
+            person.update_from_matches(self.directory.search(query),
+                    phone_type_preference=self.phone_type_preference)
+        else:
+            if self.circuit_open(self.load_state()):
+                logging.error("Not looking up '%s' on Google Contacts because the last %d syncs failed",
+                        query, self.circuit_threshold)
+                return None
+            if self.deadline is not None:
+                self.get_http_client().deadline = time.time() + self.deadline
+            try:
+                client = self.get_contacts_client()
+                self.metrics.count('api_calls')
+                with self.metrics.span('contacts_lookup'):
+                    person.update(client, phone_type_preference=self.phone_type_preference,
+                            contacts_url=self.contacts_url)
+            except Exception as exc: # pylint: disable=W0703
+                logging.error("Exception when looking up '%s' on Google Contacts: %s", query, exc)
+                lock = FileLock(self.state_file + ".lock")
+                if lock.acquire(0): # if a sync holds it, that sync records how Google is doing
+                    try:
+                        self.record_failure()
+                    finally:
+                        lock.release()
+                return None
+            finally:
+                self.get_http_client().deadline = None
         self.people[query] = person
         return person
 
-    def get_current_shift(self):
-        """Return the Shift object that overlaps with now, i.e. is current. Will sync if we haven't already."""
+    def get_people(self, queries, etag = None):
+        """Fetch a Person object into self.people for each text query, resolving all of them against one contacts directory.
+
+        If etag is given and contacts have not changed since, gdata.client.NotModified is raised."""
+        self.directory = self.get_directory(etag)
+        for query in queries:
+            self.get_person(query)
+
+    def get_directory(self, etag = None):
+        """Download all contacts page by page and return them as a ContactDirectory.
+
+        The first page tells how many contacts there are, the remaining pages are
+        then fetched at most contacts_concurrency at a time. If etag is given and
+        the first page has not changed since, gdata.client.NotModified is raised."""
+        import gdata.contacts.client
+        from nagcal.feeds import parse_contacts_feed, CONTACTS_FIELDS
+        client = self.get_contacts_client()
+
+        def get_page(start_index, etag = None):
+            """Return the contacts feed page starting at the given 1-based index as a FeedPage."""
+            query = gdata.contacts.client.ContactsQuery(
+                    start_index=start_index,
+                    max_results=ShiftCalendar.contacts_page_size)
+            self.metrics.count('api_calls')
+            with self.metrics.span('contacts_lookup'):
+                body = client.GetFeed(self.contacts_url or client.GetFeedUri(),
+                        converter=read_body, q=query, fields=CONTACTS_FIELDS,
+                        http_request=conditional_request(etag))
+            with self.metrics.span('feed_parse'):
+                return parse_contacts_feed(body)
+
+        first_page = get_page(1, etag)
+        pages = [first_page]
+        if first_page.total_results is not None:
+            total = first_page.total_results
+            pages.extend(run_concurrently(get_page,
+                    range(1 + ShiftCalendar.contacts_page_size, total + 1,
+                        ShiftCalendar.contacts_page_size),
+                    self.contacts_concurrency))
+        directory = ContactDirectory()
+        if len(pages) == 1: # the ETag only covers the first page
+            directory.etag = first_page.etag
+        for page in pages:
+            for record in page.entries:
+                directory.add(record)
+        return directory
+
+    def get_index(self):
+        """Return the ShiftIndex over all shifts. Will sync if we haven't already.
+
+        When sync() used an indexed cache, it is only read in full here, once a
+        query needs more than the single shift and person that the cache can look up."""
         if not self.have_synced:
             self.sync()
-        current_shift = None
+        if self.index is None:
+            self.load_cache()
+        return self.index
+
+    def get_current_shift(self):
+        """Return the Shift object that overlaps with now, i.e. is current. Will sync if we haven't already."""
         now = datetime.datetime.now(UTC())
-        # a bit ugly, but gets the job done
-        for shift in self.shifts:
-            if now <= shift.start:
-                continue
-            if now >= shift.end:
-                continue
-            current_shift = shift
-            break
+        current_shift = self.get_shift_at(now)
         if current_shift is None:
             logging.error("Was unable to find a shift overlapping with %s", now)
         return current_shift
 
-    def get_last_shift(self):
-        """Return the Shift object that is last in current calendar. Will sync if we haven't already."""
+    def get_shift_at(self, when):
+        """Return the Shift object on call at the given time, or None. Will sync if we haven't already.
+
+        See ShiftIndex for how overlapping shifts are resolved."""
         if not self.have_synced:
             self.sync()
-        last_shift = None
-        last_shift = self.shifts.pop()
+        if self.index is None:
+            with self.metrics.span('cache_read'):
+                return self.cache.shift_at(when)
+        return self.index.at(when)
+
+    def get_shifts_between(self, start, end):
+        """Return all Shift objects overlapping [start, end), sorted by start. Will sync if we haven't already."""
+        return self.get_index().between(start, end)
+
+    def get_next_handover(self, when):
+        """Return the first time after the given one at which the shift on call changes, or None. Will sync if we haven't already."""
+        return self.get_index().next_handover(when)
+
+    def resolve_many(self, timestamps):
+        """Generate a (timestamp, Person) pair for each of the given timestamps, in chronological order.
+
+        The timestamps are sorted once and swept against the shifts in a single
+        pass. Person is None for timestamps when noone was on call. Will sync if
+        we haven't already."""
+        for when, shift in self.get_index().sweep(sorted(timestamps)):
+            if shift is None:
+                yield when, None
+            else:
+                yield when, self.get_person(shift.title)
+
+    def get_last_shift(self):
+        """Return the Shift object that ends last in current calendar. Will sync if we haven't already."""
+        last_shift = self.get_index().last
         if last_shift is None:
             logging.error("Was asked for last shift, but there are no shifts!")
         return last_shift
 
     def get_current_person(self):
-        """Return the Person object associated with the Shift that is considered current. Will sync if haven't already."""
+        """Return the Person object associated with the Shift that is considered current. Will sync if haven't already.
+
+        Before syncing, the snapshot file is consulted and its person returned if still on call."""
         if not self.have_synced:
+            if self.snapshot_file is not None:
+                with self.metrics.span('cache_read'):
+                    person = self.read_snapshot()
+                if person is not None:
+                    self.metrics.count('cache_hits')
+                    return person
             self.sync()
         current_shift = self.get_current_shift()
         if current_shift is None:
@@ -248,27 +861,118 @@ class ShiftCalendar:
 
 class Shift:
     """Represents a single shift with a start and end time."""
-    def __init__(self, title, start, end):
+    def __init__(self, title, start, end, event_id = None):
         self.title = title
         self.start = start
         self.end = end
+        self.event_id = event_id
 
     def __repr__(self):
         return repr((self.title, self.start, self.end))
 
     def dumps(self):
         """Return a representation of this object as a string."""
-        return "%s\t%s\t%s" % (self.start, self.end, self.title)
+        return "%s\t%s\t%s\t%s" % (self.start, self.end, self.title, self.event_id)
 
     @staticmethod
     def loads(string):
         """Given a representation of an object of this class as a string, initialize and return the object."""
         string = string.split("\t")
-        return Shift(string[2].strip(), parse_date(string[0]), parse_date(string[1]))
+        event_id = None
+        if len(string) > 3 and string[3].strip() != "None":
+            event_id = string[3].strip()
+        return Shift(string[2].strip(), parse_datetime(string[0]), parse_datetime(string[1]), event_id)
+
+class ShiftIndex:
+    """Sorted index over Shifts answering point, range and handover queries in O(log n).
+
+    Where shifts overlap, the one that started most recently is on call, ties
+    broken by earliest end and then by title. A short shift placed on top of a
+    longer one thus overrides it for its duration, regardless of feed order."""
+    def __init__(self, shifts):
+        self.shifts = sorted(shifts, key=attrgetter('start', 'end', 'title'))
+        self.starts = [shift.start for shift in self.shifts]
+        self.longest = datetime.timedelta(0)
+        self.last = None
+        for shift in self.shifts:
+            self.longest = max(self.longest, shift.end - shift.start)
+            if self.last is None or shift.end >= self.last.end:
+                self.last = shift
+
+        # rank shifts by precedence: latest start, then earliest end, then title
+        by_precedence = sorted(range(len(self.shifts)), key=lambda i: self.shifts[i].title)
+        by_precedence.sort(key=lambda i: self.shifts[i].end)
+        by_precedence.sort(key=lambda i: self.shifts[i].start, reverse=True)
+        rank = [0] * len(self.shifts)
+        for position, i in enumerate(by_precedence):
+            rank[i] = position
+
+        # sweep over every start and end, recording each time the shift on call
+        # changes: self.owners[k] is on call from self.handovers[k] until the next one
+        self.handovers = []
+        self.owners = []
+        boundaries = sorted(set(self.starts + [shift.end for shift in self.shifts]))
+        active = [] # heap of (rank, i) with ended shifts removed lazily
+        started = 0
+        for boundary in boundaries:
+            while started < len(self.shifts) and self.shifts[started].start <= boundary:
+                heapq.heappush(active, (rank[started], started))
+                started += 1
+            while active and self.shifts[active[0][1]].end <= boundary:
+                heapq.heappop(active)
+            owner = self.shifts[active[0][1]] if active else None
+            if not self.owners or owner is not self.owners[-1]:
+                self.handovers.append(boundary)
+                self.owners.append(owner)
+
+    def __len__(self):
+        return len(self.shifts)
+
+    def at(self, when):
+        """Return the Shift on call at the given time, or None if there is none."""
+        position = bisect.bisect_right(self.handovers, when) - 1
+        if position < 0:
+            return None
+        return self.owners[position]
+
+    def between(self, start, end):
+        """Return all Shifts overlapping [start, end), sorted by start."""
+        # no shift is longer than self.longest, so none starting before
+        # start - self.longest can reach into the range
+        first = bisect.bisect_right(self.starts, start - self.longest)
+        last = bisect.bisect_left(self.starts, end)
+        return [shift for shift in self.shifts[first:last] if shift.end > start]
+
+    def sweep(self, timestamps):
+        """Generate a (timestamp, Shift) pair for each timestamp in a sorted iterable in O(n + m).
+
+        Shift is None for timestamps where there is no shift on call."""
+        position = -1
+        for when in timestamps:
+            while position + 1 < len(self.handovers) and self.handovers[position + 1] <= when:
+                position += 1
+            if position < 0:
+                yield when, None
+            else:
+                yield when, self.owners[position]
+
+    def next_handover(self, when):
+        """Return the first time after the given one at which the Shift on call changes, or None."""
+        position = bisect.bisect_right(self.handovers, when)
+        if position == len(self.handovers):
+            return None
+        return self.handovers[position]
+
+    def previous_handover(self, when):
+        """Return the last time not after the given one at which the Shift on call changed, or None."""
+        position = bisect.bisect_right(self.handovers, when) - 1
+        if position < 0:
+            return None
+        return self.handovers[position]
 
 class Person:
     """Represents a person that can be responsible for multiple Shifts."""
-    def __init__(self, query, email = None, phone = None):
+    def __init__(self, query, email = None, phone = None, fetched = None):
         self.query = query
         if email == "None":
             self.email = None
@@ -278,57 +982,280 @@ class Person:
             self.phone = None
         else:
             self.phone = phone
+        if fetched == "None":
+            self.fetched = None
+        else:
+            self.fetched = fetched
         self.have_synced = False
 
+    def is_fresh(self, ttl):
+        """Return True if email and phone number were fetched from Google less than ttl seconds ago."""
+        return self.fetched is not None and time.time() - self.fetched < ttl
+
     def __repr__(self):
         return repr((self.query, self.email, self.phone))
 
     def update(self, client, **kwargs):
         """Search for Person.query on Google Contacts and set email and phone number from first match.
         
+        The contacts feed at the contacts_url keyword argument is searched if given.
+        Will only sync once per instance."""
+        if not self.have_synced:
+            import gdata.contacts.client
+            from nagcal.feeds import parse_contacts_feed, CONTACTS_FIELDS
+            query = gdata.contacts.client.ContactsQuery()
+            query.text_query = self.query
+            page = parse_contacts_feed(client.GetFeed(kwargs.get('contacts_url') or client.GetFeedUri(),
+                converter=read_body, q=query, fields=CONTACTS_FIELDS))
+            self.update_from_matches(page.entries, **kwargs)
+
+    def update_from_matches(self, matches, **kwargs):
+        """Set email and phone number from the first of the contact records matching Person.query.
+
         Will only sync once per instance."""
         phone_type_preference = ShiftCalendar.default_phone_type_preference
         if 'phone_type_preference' in kwargs:
             phone_type_preference = kwargs['phone_type_preference']
         if not self.have_synced:
-            query = gdata.contacts.client.ContactsQuery()
-            query.text_query = self.query
-            feed = client.GetContacts(q = query)
-            entry = None
-            if len(feed.entry) == 1:
-                entry = feed.entry[0]
-            elif len(feed.entry) > 1:
-                entry = feed.entry[0]
-                logging.warning("Calendar title '%s' is too broad, matches %d contacts.", self.query, len(feed.entry))
-            if entry is None:
+            record = None
+            if len(matches) == 1:
+                record = matches[0]
+            elif len(matches) > 1:
+                record = matches[0]
+                logging.warning("Calendar title '%s' is too broad, matches %d contacts.", self.query, len(matches))
+            if record is None:
                 logging.error("Current shift does not match any contact! Query was: '%s'", self.query)
                 sys.exit(os.EX_DATAERR)
             person = {'email': None, 'phone': None}
-            for email in entry.email:
-                if email.primary and email.primary == 'true':
-                    person['email'] = email.address
-            phone_numbers = {}
-            for phone in entry.phone_number:
-                # rel example: http://schemas.google.com/g/2005#mobile
-                rel = phone.rel.split("#").pop()
-                phone_numbers[rel] = phone.text
+            for address, primary in record['emails']:
+                if primary:
+                    person['email'] = address
+            phone_numbers = dict(record['phones'])
             for rel in phone_type_preference:
                 if rel in phone_numbers:
                     person['phone'] = phone_numbers[rel]
 
             self.email = person['email']
             self.phone = person['phone']
+            self.fetched = int(time.time())
             self.have_synced = True
 
     def dumps(self):
         """Return a representation of this object as a string."""
-        return "%s\t%s\t%s" % (self.query, self.email, self.phone)
+        return "%s\t%s\t%s\t%s" % (self.query, self.email, self.phone, self.fetched)
 
     @staticmethod
     def loads(string):
         """Given a representation of an object of this class as a string, initialize and return the object."""
         string = string.split("\t")
-        return Person(string[0].strip(), string[1].strip(), string[2].strip())
+        fetched = None
+        if len(string) > 3 and string[3].strip() != "None":
+            fetched = int(string[3])
+        return Person(string[0].strip(), string[1].strip(), string[2].strip(), fetched)
+
+class ContactDirectory:
+    """Local search index over contact records, keyed on name, email address and nickname."""
+    def __init__(self):
+        self.records = []
+        self.etag = None
+        self.keys = {} # normalized name, address or nickname -> positions in self.records
+        self.words = {} # each word of the above -> positions in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    @staticmethod
+    def normalize(text):
+        """Return text in the form used for keys: lower case with whitespace collapsed."""
+        return " ".join(text.lower().split())
+
+    def add(self, record):
+        """Add a contact record as returned by parse_contacts_feed to the index."""
+        position = len(self.records)
+        self.records.append(record)
+        for key in record['names'] + [address for address, _ in record['emails']]:
+            key = ContactDirectory.normalize(key)
+            self.keys.setdefault(key, set()).add(position)
+            for word in key.split():
+                self.words.setdefault(word, set()).add(position)
+
+    def search(self, query):
+        """Return the records matching a calendar title, ordered by contact id.
+
+        Records with a name, address or nickname equal to the query match first.
+        Failing that, records whose names and addresses contain every word of the
+        query match, like a full-text search on Google Contacts would."""
+        query = ContactDirectory.normalize(query)
+        positions = self.keys.get(query)
+        if not positions:
+            positions = None
+            for word in query.split():
+                if positions is None:
+                    positions = set(self.words.get(word, ()))
+                else:
+                    positions &= self.words.get(word, set())
+        return sorted([self.records[position] for position in positions or ()],
+                key=lambda record: record['id'])
+
+def run_concurrently(function, items, concurrency):
+    """Call function on each item using at most concurrency threads and return the results in item order.
+
+    If any call raises, remaining items are skipped and the first exception,
+    including SystemExit, is re-raised here once all threads have stopped."""
+    pending = Queue.Queue()
+    for position, item in enumerate(items):
+        pending.put((position, item))
+    results = [None] * pending.qsize()
+    failures = []
+
+    def work():
+        """Process items until there are none left or a call has failed."""
+        while not failures:
+            try:
+                position, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[position] = function(item)
+            except: # pylint: disable=W0702
+                failures.append(sys.exc_info())
+
+    workers = [threading.Thread(target=work)
+            for _ in range(min(concurrency, len(results)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    return results
+
+def read_body(response):
+    """Return the body of a response as is. Used as gdata converter to skip building gdata objects."""
+    return response.read()
+
+def conditional_request(etag):
+    """Return an atom.http_core.HttpRequest that is only answered in full if it does not match etag."""
+    import atom.http_core
+    http_request = atom.http_core.HttpRequest()
+    if etag is not None:
+        http_request.headers['If-None-Match'] = etag
+    return http_request
+
+def prefetch(iterable):
+    """Generate the items of iterable, producing each next item in a background thread while the current one is used.
+
+    Exceptions raised by iterable are re-raised to the consumer."""
+    items = Queue.Queue(maxsize=1)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        """Put items on the queue until iterable is exhausted or the consumer has stopped."""
+        try:
+            for item in iterable:
+                items.put((item, None))
+                if stopped.is_set():
+                    return
+            items.put((done, None))
+        except: # pylint: disable=W0702
+            items.put((None, sys.exc_info()))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, failure = items.get()
+            if failure is not None:
+                raise failure[0], failure[1], failure[2]
+            if item is done:
+                return
+            yield item
+    finally:
+        # unblock a producer waiting to put an item nobody will get
+        stopped.set()
+        try:
+            items.get_nowait()
+        except Queue.Empty:
+            pass
+
+class FileLock:
+    """An exclusive lock shared between processes, held on a lock file with flock()."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock_file = None
+
+    def acquire(self, timeout = None):
+        """Take the lock, waiting at most timeout seconds or forever if None. Return True if the lock was taken."""
+        self.lock_file = open(self.filename, 'a')
+        if timeout is None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            return True
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if time.time() >= deadline:
+                self.lock_file.close()
+                self.lock_file = None
+                return False
+            time.sleep(0.05)
+
+    def release(self):
+        """Give up the lock if it is held."""
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+def write_atomically(filename, data):
+    """Replace the contents of filename with data so that readers see either the old or the new contents."""
+    if os.path.exists(filename):
+        mode = os.stat(filename).st_mode & 0o777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    handle, temporary = tempfile.mkstemp(
+            prefix=".%s." % os.path.basename(filename),
+            dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        temporary_file = os.fdopen(handle, 'w')
+        try:
+            temporary_file.write(data)
+        finally:
+            temporary_file.close()
+        os.chmod(temporary, mode)
+        os.rename(temporary, filename)
+    except:
+        os.unlink(temporary)
+        raise
+
+def parse_datetime(text):
+    """Return the timezone-aware datetime for a timestamp in the cache, converted to UTC.
+
+    Timestamps as written by str(datetime) are parsed without iso8601, which
+    is only imported for anything else."""
+    text = text.strip()
+    match = CACHED_DATETIME.match(text)
+    if match is None:
+        from iso8601 import parse_date # pylint: disable=E0611
+        return parse_date(text)
+    year, month, day, hour, minute, second, fraction, sign, offset_hours, offset_minutes = match.groups()
+    when = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+            int((fraction or "0").ljust(6, "0")), UTC())
+    if sign is not None:
+        offset = datetime.timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        if sign == "+":
+            when -= offset
+        else:
+            when += offset
+    return when
 
 class UTC(datetime.tzinfo):
     """Class representing the UTC "timezone". Necessary to work with timezone-aware datetime objects."""
@@ -0,0 +1,414 @@
+"""On-disk caches of synced shifts and people, selected with the cache_backend setting.
+
+Every backend offers the same interface:
+    files -- the files the cache is kept in, whose modification times tell its age
+    indexed -- True if shift_at, person and count can answer without load
+    load() -- return all cached shifts and people, as lists of Shifts and Persons
+    save(generation, shifts, people) -- replace the cached shifts and people
+    touch() -- mark the cache as just synced, without changing it
+    shift_at(when) -- return the Shift on call at datetime when, or None
+    person(query) -- return the cached Person for query, or None
+    count() -- return the number of cached shifts
+    generation() -- return the generation passed to the last save, or None if there is none
+"""
+import os
+import mmap
+import struct
+import logging
+import calendar
+import datetime
+import nagcal
+
+GENERATION_HEADER = "# generation " # first line of cache files, naming the sync that wrote them
+
+class TextCache:
+    """Cache kept in two tab separated text files, one for shifts and one for people.
+
+    Both files start with the generation of the sync that wrote them. A sync
+    replaces them one after the other, so if they are read in between, the
+    generations differ and they are read again."""
+    indexed = False
+    read_attempts = 3 # times to read the files while they are from different syncs
+
+    def __init__(self, calendar_file, contacts_file):
+        self.calendar_file = calendar_file
+        self.contacts_file = contacts_file
+        self.files = [calendar_file, contacts_file]
+        # make sure cache files are present and at least readable
+        for filename in self.files:
+            try:
+                cache_file = open(filename, 'r')
+            except IOError:
+                cache_file = open(filename, 'w')
+            finally:
+                cache_file.close()
+
+    def load(self):
+        """Return lists of all cached Shifts and Persons."""
+        for _ in range(TextCache.read_attempts):
+            calendar_generation, calendar_lines = read_lines(self.calendar_file)
+            contacts_generation, contacts_lines = read_lines(self.contacts_file)
+            if calendar_generation == contacts_generation:
+                break
+        else:
+            logging.warning("Calendar and contacts caches are from different syncs, using them anyway")
+        return ([nagcal.Shift.loads(line) for line in calendar_lines],
+                [nagcal.Person.loads(line) for line in contacts_lines])
+
+    def save(self, generation, shifts, people):
+        """Atomically replace both files, contacts first, tagged with generation."""
+        write_lines(self.contacts_file, generation, [person.dumps() for person in people])
+        write_lines(self.calendar_file, generation, [shift.dumps() for shift in shifts])
+
+    def touch(self):
+        """Mark both files as just synced."""
+        for filename in self.files:
+            os.utime(filename, None)
+
+    def shift_at(self, when):
+        """Return the Shift on call at when, or None."""
+        return nagcal.ShiftIndex(self.load()[0]).at(when)
+
+    def person(self, query):
+        """Return the cached Person for query, or None."""
+        for person in self.load()[1]:
+            if person.query == query:
+                return person
+        return None
+
+    def count(self):
+        """Return the number of cached shifts."""
+        return len(read_lines(self.calendar_file)[1])
+
+    def generation(self):
+        """Return the generation both files were saved with, or None if they differ or have none."""
+        generations = set()
+        for filename in self.files:
+            cache_file = open(filename, 'r')
+            try:
+                first_line = cache_file.readline()
+            finally:
+                cache_file.close()
+            if not first_line.startswith(GENERATION_HEADER):
+                return None
+            generations.add(first_line[len(GENERATION_HEADER):].strip())
+        if len(generations) != 1:
+            return None
+        return int(generations.pop())
+
+class SqliteCache:
+    """Cache kept in an SQLite database, with shifts indexed on their start and end times.
+
+    Times are stored as seconds since the epoch, so finding the shift on call
+    is a single indexed query, and people are looked up by their query. Saves
+    replace everything in one transaction, so readers see one sync or the other,
+    and the database is in WAL mode, so readers are not blocked while it commits."""
+    indexed = True
+    timeout = 10 # seconds to wait for a save in another process to finish
+    schema = """
+        CREATE TABLE IF NOT EXISTS shifts (
+            start INTEGER NOT NULL, end INTEGER NOT NULL, title TEXT NOT NULL, event_id TEXT);
+        CREATE INDEX IF NOT EXISTS shifts_start_end ON shifts (start, end);
+        CREATE TABLE IF NOT EXISTS people (
+            query TEXT PRIMARY KEY, email TEXT, phone TEXT, fetched INTEGER);
+        """
+
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        self.files = [filename]
+        self.connection = sqlite3.connect(filename, timeout=SqliteCache.timeout)
+        self.connection.isolation_level = None # transactions are begun explicitly
+        self.connection.text_factory = str # titles and names are kept as UTF-8
+        # with a write-ahead log, lookups keep reading the last sync while a new one commits
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SqliteCache.schema)
+
+    def load(self):
+        """Return lists of all cached Shifts and Persons, from the same sync."""
+        self.connection.execute("BEGIN")
+        try:
+            shifts = [to_shift(row) for row in self.connection.execute(
+                    "SELECT start, end, title, event_id FROM shifts ORDER BY start")]
+            people = [to_person(row) for row in self.connection.execute(
+                    "SELECT query, email, phone, fetched FROM people")]
+        finally:
+            self.connection.execute("COMMIT")
+        return shifts, people
+
+    def save(self, generation, shifts, people):
+        """Replace all shifts and people in one transaction, recording generation as the database's user version."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("DELETE FROM shifts")
+            self.connection.executemany("INSERT INTO shifts VALUES (?, ?, ?, ?)",
+                    ((to_epoch(shift.start), to_epoch(shift.end), shift.title, shift.event_id)
+                        for shift in shifts))
+            self.connection.execute("DELETE FROM people")
+            self.connection.executemany("INSERT INTO people VALUES (?, ?, ?, ?)",
+                    ((person.query, person.email, person.phone, person.fetched)
+                        for person in people))
+            self.connection.execute("PRAGMA user_version = %d" % int(generation))
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+        # the commit went to the write-ahead log, the database file tells cache_age()
+        self.touch()
+
+    def touch(self):
+        """Mark the database as just synced."""
+        os.utime(self.filename, None)
+
+    def shift_at(self, when):
+        """Return the Shift on call at when, or None, with the precedence of ShiftIndex."""
+        epoch = to_epoch(when)
+        row = self.connection.execute("SELECT start, end, title, event_id FROM shifts "
+                "WHERE start <= ? AND end > ? ORDER BY start DESC, end ASC, title LIMIT 1",
+                (epoch, epoch)).fetchone()
+        if row is None:
+            return None
+        return to_shift(row)
+
+    def person(self, query):
+        """Return the cached Person for query, or None."""
+        row = self.connection.execute("SELECT query, email, phone, fetched FROM people "
+                "WHERE query = ?", (query,)).fetchone()
+        if row is None:
+            return None
+        return to_person(row)
+
+    def count(self):
+        """Return the number of cached shifts."""
+        return self.connection.execute("SELECT COUNT(*) FROM shifts").fetchone()[0]
+
+    def generation(self):
+        """Return the generation recorded as the database's user version, or None if nothing was saved."""
+        return self.connection.execute("PRAGMA user_version").fetchone()[0] or None
+
+class MmapCache:
+    """Cache kept in one file of fixed-width records, which lookups binary search in place through mmap.
+
+    The file holds, after a header with the generation and the number of each
+    kind of record:
+        shifts -- (start, end, title, event_id) sorted by start, end and title
+        segments -- (handover, shift) from ShiftIndex: the position of the shift
+                    on call from handover until the next one, or -1 if none is
+        people -- (query, email, phone, fetched) sorted by query
+    followed by a table of NUL terminated strings that the records point into.
+    Times are seconds since the epoch. Finding the person on call thus reads a
+    few records and strings, without parsing or allocating anything per shift."""
+    indexed = True
+    magic = "NAGCAL1\0"
+    header = struct.Struct("<8sQIII4x") # magic, generation, shifts, segments, people
+    shift = struct.Struct("<qqII") # start, end, title, event_id
+    segment = struct.Struct("<qi4x") # handover, shift position
+    person_record = struct.Struct("<III4xq") # query, email, phone, fetched
+    no_string = 0xffffffff # string offset standing for None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = [filename]
+        self.mapped = None # (inode, modification time, mmap) of the file
+        if not os.path.exists(filename):
+            open(filename, 'w').close()
+
+    def map(self):
+        """Return the file mapped into memory, mapping it again if it was replaced, or None if it is empty."""
+        stat = os.stat(self.filename)
+        if self.mapped is None or self.mapped[:2] != (stat.st_ino, stat.st_mtime):
+            data = None
+            if stat.st_size >= MmapCache.header.size:
+                cache_file = open(self.filename, 'rb')
+                try:
+                    data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+                finally:
+                    cache_file.close()
+                if data[:len(MmapCache.magic)] != MmapCache.magic:
+                    logging.warning("Ignoring %s, it is not a NaGCal cache", self.filename)
+                    data = None
+            self.mapped = (stat.st_ino, stat.st_mtime, data)
+        return self.mapped[2]
+
+    def layout(self, data):
+        """Return the counts and offsets of shifts, segments, people and strings in mapped data."""
+        _, _, shifts, segments, people = MmapCache.header.unpack_from(data)
+        shifts_at = MmapCache.header.size
+        segments_at = shifts_at + shifts * MmapCache.shift.size
+        people_at = segments_at + segments * MmapCache.segment.size
+        strings_at = people_at + people * MmapCache.person_record.size
+        return shifts, segments, people, shifts_at, segments_at, people_at, strings_at
+
+    def load(self):
+        """Return lists of all cached Shifts and Persons."""
+        data = self.map()
+        if data is None:
+            return [], []
+        shifts, _, people, shifts_at, _, people_at, strings_at = self.layout(data)
+        return ([self.read_shift(data, shifts_at, strings_at, i) for i in range(shifts)],
+                [self.read_person(data, people_at, strings_at, i) for i in range(people)])
+
+    def save(self, generation, shifts, people):
+        """Atomically replace the file with shifts, their handovers and people."""
+        strings = []
+        offsets = {}
+        def string(text):
+            """Return the offset of text in the string table, adding it if it is new."""
+            if text is None:
+                return MmapCache.no_string
+            if text not in offsets:
+                offsets[text] = offsets.get(None, 0)
+                offsets[None] = offsets[text] + len(text) + 1 # end of the table
+                strings.append(text)
+            return offsets[text]
+
+        index = nagcal.ShiftIndex(shifts)
+        positions = dict((id(shift), i) for i, shift in enumerate(index.shifts))
+        people = sorted(people, key=lambda person: person.query)
+        records = [MmapCache.header.pack(MmapCache.magic, int(generation),
+                len(index.shifts), len(index.handovers), len(people))]
+        for shift in index.shifts:
+            records.append(MmapCache.shift.pack(to_epoch(shift.start), to_epoch(shift.end),
+                    string(shift.title), string(shift.event_id)))
+        for handover, owner in zip(index.handovers, index.owners):
+            records.append(MmapCache.segment.pack(to_epoch(handover),
+                    -1 if owner is None else positions[id(owner)]))
+        for person in people:
+            fetched = person.fetched
+            if fetched is None:
+                fetched = -1
+            records.append(MmapCache.person_record.pack(string(person.query),
+                    string(person.email), string(person.phone), fetched))
+        records.extend("%s\0" % text for text in strings)
+        nagcal.write_atomically(self.filename, "".join(records))
+
+    def touch(self):
+        """Mark the file as just synced."""
+        os.utime(self.filename, None)
+
+    def shift_at(self, when):
+        """Return the Shift on call at when, or None, by binary search over the handovers."""
+        data = self.map()
+        if data is None:
+            return None
+        _, segments, _, shifts_at, segments_at, _, strings_at = self.layout(data)
+        epoch = to_epoch(when)
+        low, high = 0, segments # find the first handover after when
+        while low < high:
+            middle = (low + high) // 2
+            if MmapCache.segment.unpack_from(data, segments_at + middle * MmapCache.segment.size)[0] <= epoch:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        position = MmapCache.segment.unpack_from(data, segments_at + (low - 1) * MmapCache.segment.size)[1]
+        if position < 0:
+            return None
+        return self.read_shift(data, shifts_at, strings_at, position)
+
+    def person(self, query):
+        """Return the cached Person for query, or None, by binary search over the people."""
+        data = self.map()
+        if data is None:
+            return None
+        _, _, people, _, _, people_at, strings_at = self.layout(data)
+        low, high = 0, people
+        while low < high:
+            middle = (low + high) // 2
+            found = read_string(data, strings_at, MmapCache.person_record.unpack_from(
+                    data, people_at + middle * MmapCache.person_record.size)[0])
+            if found == query:
+                return self.read_person(data, people_at, strings_at, middle)
+            if found < query:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def count(self):
+        """Return the number of cached shifts."""
+        data = self.map()
+        if data is None:
+            return 0
+        return MmapCache.header.unpack_from(data)[2]
+
+    def generation(self):
+        """Return the generation in the header, or None if the file is empty."""
+        data = self.map()
+        if data is None:
+            return None
+        return MmapCache.header.unpack_from(data)[1]
+
+    @staticmethod
+    def read_shift(data, shifts_at, strings_at, position):
+        """Return the Shift in the record at position."""
+        start, end, title, event_id = MmapCache.shift.unpack_from(
+                data, shifts_at + position * MmapCache.shift.size)
+        return nagcal.Shift(read_string(data, strings_at, title),
+                from_epoch(start), from_epoch(end), read_string(data, strings_at, event_id))
+
+    @staticmethod
+    def read_person(data, people_at, strings_at, position):
+        """Return the Person in the record at position."""
+        query, email, phone, fetched = MmapCache.person_record.unpack_from(
+                data, people_at + position * MmapCache.person_record.size)
+        if fetched < 0:
+            fetched = None
+        return nagcal.Person(read_string(data, strings_at, query),
+                read_string(data, strings_at, email), read_string(data, strings_at, phone), fetched)
+
+BACKENDS = ('text', 'sqlite', 'mmap')
+
+def open_cache(backend, calendar_file, contacts_file):
+    """Return the cache for the named backend, kept in or next to calendar_file and contacts_file."""
+    if backend == 'text':
+        return TextCache(calendar_file, contacts_file)
+    if backend == 'sqlite':
+        return SqliteCache(calendar_file + ".sqlite")
+    if backend == 'mmap':
+        return MmapCache(calendar_file + ".records")
+    raise ValueError("Unknown cache backend %r, expected one of %s" % (backend, ", ".join(BACKENDS)))
+
+def read_lines(filename):
+    """Return the generation and the non-blank lines of a text cache file.
+
+    The generation is None for cache files written before generations were recorded."""
+    cache_file = open(filename, 'r')
+    try:
+        lines = cache_file.readlines()
+    finally:
+        cache_file.close()
+    generation = None
+    if lines and lines[0].startswith(GENERATION_HEADER):
+        generation = lines.pop(0)[len(GENERATION_HEADER):].strip()
+    return generation, [line for line in lines if line.strip()]
+
+def write_lines(filename, generation, lines):
+    """Atomically replace a text cache file with a generation header followed by lines."""
+    nagcal.write_atomically(filename, "%s%s\n%s" % (GENERATION_HEADER, generation,
+            "".join("%s\n" % line for line in lines)))
+
+def read_string(data, strings_at, offset):
+    """Return the NUL terminated string at offset in the string table of an MmapCache, or None."""
+    if offset == MmapCache.no_string:
+        return None
+    start = strings_at + offset
+    return data[start:data.find("\0", start)]
+
+def to_epoch(when):
+    """Return a timezone-aware datetime as whole seconds since the epoch."""
+    return calendar.timegm(when.utctimetuple())
+
+def to_shift(row):
+    """Return a Shift for a (start, end, title, event_id) row with epoch times."""
+    start, end, title, event_id = row
+    return nagcal.Shift(title, from_epoch(start), from_epoch(end), event_id)
+
+def to_person(row):
+    """Return a Person for a (query, email, phone, fetched) row."""
+    return nagcal.Person(*row)
+
+def from_epoch(seconds):
+    """Return seconds since the epoch as a UTC datetime."""
+    return datetime.datetime.fromtimestamp(seconds, nagcal.UTC())
@@ -0,0 +1,86 @@
+"""Lightweight parsers for the few parts of Google Data API feeds that NaGCal uses.
+
+Feeds are requested with a fields parameter so Google only sends these parts
+(see CALENDAR_FIELDS and CONTACTS_FIELDS), and are parsed with ElementTree
+into plain tuples and dictionaries instead of gdata's object model."""
+from iso8601 import parse_date # pylint: disable=E0611
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+ATOM = "{http://www.w3.org/2005/Atom}"
+GD = "{http://schemas.google.com/g/2005}"
+GCONTACT = "{http://schemas.google.com/contact/2008}"
+OPENSEARCH = "{http://a9.com/-/spec/opensearch/1.1/}"
+
+CALENDAR_FIELDS = "@gd:etag,updated,link[@rel='next'],entry(id,title,gd:when,gd:eventStatus)"
+CONTACTS_FIELDS = "@gd:etag,openSearch:totalResults,link[@rel='next']," + \
+        "entry(id,title,gd:name,gContact:nickname,gd:email,gd:phoneNumber)"
+CANCELED_STATUS = "http://schemas.google.com/g/2005#event.canceled"
+
+class FeedPage:
+    """One page of a feed: its ETag, updated time, total number of results, link to the next page and entries."""
+    def __init__(self, root):
+        self.etag = root.get(GD + "etag")
+        self.updated = root.findtext(ATOM + "updated")
+        self.next_url = None
+        for link in root.findall(ATOM + "link"):
+            if link.get("rel") == "next":
+                self.next_url = link.get("href")
+        total_results = root.findtext(OPENSEARCH + "totalResults")
+        self.total_results = None
+        if total_results:
+            self.total_results = int(total_results)
+        self.entries = []
+
+def parse_event_feed(xml):
+    """Return a FeedPage for a calendar event feed.
+
+    Its entries are (event_id, title, start, end, canceled) tuples, where start
+    and end are datetimes, or None for canceled events."""
+    root = ElementTree.fromstring(xml)
+    page = FeedPage(root)
+    for entry in root.findall(ATOM + "entry"):
+        event_id = entry.findtext(ATOM + "id")
+        status = entry.find(GD + "eventStatus")
+        if status is not None and status.get("value") == CANCELED_STATUS:
+            page.entries.append((event_id, None, None, None, True))
+            continue
+        when = entry.find(GD + "when")
+        if when is None: # nothing to be on call for
+            continue
+        page.entries.append((event_id, utf8(entry.findtext(ATOM + "title", "")),
+                parse_date(when.get("startTime")), parse_date(when.get("endTime")), False))
+    return page
+
+def parse_contacts_feed(xml):
+    """Return a FeedPage for a contacts feed whose entries are contact records.
+
+    A contact record is a dictionary with the contact's 'id', 'names' holding the
+    full name, title and nickname, 'emails' holding (address, primary) pairs and
+    'phones' holding (type, number) pairs, where type is e.g. "mobile"."""
+    root = ElementTree.fromstring(xml)
+    page = FeedPage(root)
+    for entry in root.findall(ATOM + "entry"):
+        record = {'id': entry.findtext(ATOM + "id", ""),
+                'names': [], 'emails': [], 'phones': []}
+        for name in (entry.findtext(ATOM + "title"),
+                entry.findtext(GCONTACT + "nickname"),
+                entry.findtext("%sname/%sfullName" % (GD, GD))):
+            if name:
+                record['names'].append(utf8(name))
+        for email in entry.findall(GD + "email"):
+            record['emails'].append((email.get("address"), email.get("primary") == "true"))
+        for phone in entry.findall(GD + "phoneNumber"):
+            # rel example: http://schemas.google.com/g/2005#mobile
+            if phone.get("rel"):
+                record['phones'].append((phone.get("rel").split("#").pop(), phone.text))
+        page.entries.append(record)
+    return page
+
+def utf8(text):
+    """Return text as a UTF-8 encoded str, like the rest of NaGCal expects."""
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+    return text
@@ -0,0 +1,176 @@
+"""Timing spans and counters for one run of NaGCal, exported as a JSON line or a Prometheus textfile.
+
+ShiftCalendar times these phases of its work:
+    token_refresh -- refreshing the OAuth access token, including waiting for another process to do it
+    calendar_fetch -- each request for a page of the calendar event feed
+    contacts_lookup -- each request for contacts, a page of all of them or a search for one title
+    feed_parse -- parsing each page of a feed
+    cache_read -- reading shifts, people or the snapshot from the cache
+    cache_write -- writing shifts and people, or the snapshot, to the cache
+
+and counts:
+    cache_hits -- lookups answered from the cache or snapshot without syncing
+    cache_misses -- lookups that found the cache too old and tried to sync
+    fallbacks -- syncs that used the cache instead, as Google failed, the circuit
+                 was open or another process was syncing
+    sync_failures -- syncs that failed
+    api_calls -- requests made to Google
+
+The JSON format appends one line per run to metrics_file, for log shippers. The
+Prometheus format rewrites metrics_file for the node_exporter textfile collector,
+adding each run to the totals already in it and replacing the gauges of the last run.
+"""
+import os
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager
+import nagcal
+
+FORMATS = ('json', 'prometheus')
+PROMETHEUS_PREFIX = "nagcal_"
+
+class Metrics:
+    """Timing spans and counters collected during one run, safe to update from several threads."""
+    def __init__(self, filename = None, metrics_format = 'json', **labels):
+        """Collect metrics to be exported to filename in metrics_format, labelled with the keyword arguments.
+
+        If filename is None, metrics are collected but export() does nothing."""
+        if metrics_format not in FORMATS:
+            raise ValueError("Unknown metrics format %r, expected one of %s" % (metrics_format, ", ".join(FORMATS)))
+        self.filename = filename
+        self.format = metrics_format
+        self.lock = threading.Lock()
+        self.labels = {}
+        self.reset(**labels)
+
+    def reset(self, **labels):
+        """Forget everything collected so far and start a new run, updating labels with the keyword arguments."""
+        with self.lock:
+            self.labels.update(labels)
+            self.started = time.time()
+            self.spans = {} # name -> [number of spans, total seconds, longest seconds]
+            self.counters = {}
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block as one span of the named phase, also when it raises."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                span = self.spans.setdefault(name, [0, 0.0, 0.0])
+                span[0] += 1
+                span[1] += elapsed
+                span[2] = max(span[2], elapsed)
+
+    def count(self, name, increment = 1):
+        """Add increment to the named counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def as_dict(self):
+        """Return everything collected so far as a dictionary that can be serialized to JSON."""
+        with self.lock:
+            return {
+                    'time': int(self.started),
+                    'seconds': round(time.time() - self.started, 6),
+                    'labels': dict(self.labels),
+                    'spans': dict((name, {'count': count, 'seconds': round(total, 6),
+                        'max_seconds': round(longest, 6)})
+                        for name, (count, total, longest) in self.spans.items()),
+                    'counters': dict(self.counters),
+                    }
+
+    def export(self):
+        """Write the metrics of this run to filename in the configured format, if a filename was given."""
+        if self.filename is None:
+            return
+        if self.format == 'json':
+            # a single write of a line to a file opened for appending is not interleaved with others
+            handle = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(handle, json.dumps(self.as_dict(), sort_keys=True) + "\n")
+            finally:
+                os.close(handle)
+            return
+        lock = nagcal.FileLock(self.filename + ".lock")
+        lock.acquire()
+        try:
+            samples = read_prometheus(self.filename)
+            add_prometheus(samples, self.as_dict())
+            nagcal.write_atomically(self.filename, dumps_prometheus(samples))
+        finally:
+            lock.release()
+
+def read_prometheus(filename):
+    """Return the samples in a Prometheus textfile as a dictionary of 'name{labels}' -> value, empty if unreadable."""
+    samples = {}
+    try:
+        metrics_file = open(filename, 'r')
+    except IOError:
+        return samples
+    try:
+        for line in metrics_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, _, value = line.rpartition(" ")
+            try:
+                samples[key] = float(value)
+            except ValueError:
+                pass
+    finally:
+        metrics_file.close()
+    return samples
+
+def add_prometheus(samples, run):
+    """Add a run, as returned by Metrics.as_dict, to the samples of a Prometheus textfile.
+
+    Counters (named *_total) are added to, gauges of the last run are replaced."""
+    labels = run['labels']
+    def key(name, **extra):
+        """Return the sample key for a metric name with the run's labels and extra labels."""
+        all_labels = dict(labels, **extra)
+        return "%s%s{%s}" % (PROMETHEUS_PREFIX, name, ",".join('%s="%s"' % (label,
+                str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                for label, value in sorted(all_labels.items())))
+    def add(name, value, **extra):
+        """Add value to a counter."""
+        sample = key(name, **extra)
+        samples[sample] = samples.get(sample, 0) + value
+
+    add("runs_total", 1)
+    add("run_seconds_total", run['seconds'])
+    samples[key("last_run_timestamp_seconds")] = run['time']
+    samples[key("last_run_seconds")] = run['seconds']
+    # phases the last run did not go through have no time in it
+    for sample in samples.keys():
+        if sample.startswith(PROMETHEUS_PREFIX + "last_run_phase_seconds{") and \
+                re.sub(r'phase="[^"]*",?', "", sample).replace(",}", "}") == key("last_run_phase_seconds"):
+            del samples[sample]
+    for name, span in run['spans'].items():
+        add("phase_seconds_total", span['seconds'], phase=name)
+        add("phase_spans_total", span['count'], phase=name)
+        samples[key("last_run_phase_seconds", phase=name)] = span['seconds']
+    for name, value in run['counters'].items():
+        add("%s_total" % name, value)
+
+def dumps_prometheus(samples):
+    """Return samples as the contents of a Prometheus textfile, with a TYPE line for each metric."""
+    lines = []
+    metric = None
+    for sample in sorted(samples):
+        name = sample.split("{", 1)[0]
+        if name != metric:
+            metric = name
+            lines.append("# TYPE %s %s" % (name, "counter" if name.endswith("_total") else "gauge"))
+        value = samples[sample]
+        if value == int(value):
+            lines.append("%s %d" % (sample, value))
+        else:
+            lines.append("%s %.6f" % (sample, value))
+    return "".join("%s\n" % line for line in lines)
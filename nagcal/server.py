@@ -0,0 +1,102 @@
+"""A resident lookup daemon answering on-call queries over a Unix socket.
+
+Keeping one ShiftCalendar in memory means a lookup costs a socket round trip
+instead of a Python start-up, imports and a full cache parse.
+
+The protocol is one line per connection. The client sends a query such as
+"current email" or "current phone" and the server replies with either
+"OK <value>" or "ERR <reason>" before closing the connection.
+"""
+import os
+import stat
+import time
+import socket
+import logging
+import SocketServer
+
+class ShiftRequestHandler(SocketServer.StreamRequestHandler):
+    """Answer a single query line from a client."""
+    fields = ("email", "phone")
+    # seconds to wait for the query, as one client that sends nothing holds up all others
+    timeout = 1
+
+    def handle(self):
+        try:
+            query = self.rfile.readline(256).split()
+        except socket.timeout:
+            logging.warning("Dropping a client that sent no query within %ds", self.timeout)
+            return
+        try:
+            reply = "OK %s" % self.server.answer(query)
+        except LookupError as exc:
+            reply = "ERR %s" % exc
+        except (Exception, SystemExit) as exc: # pylint: disable=W0703
+            # Person.update() exits when a title matches no contact, which
+            # must not take the whole daemon down with it.
+            logging.error("Exception when answering %r: %r", query, exc)
+            reply = "ERR internal error"
+        self.wfile.write("%s\n" % reply)
+
+class ShiftServer(SocketServer.UnixStreamServer):
+    """Serve lookups against one ShiftCalendar, re-syncing it whenever the cache changes or expires."""
+    request_queue_size = 128 # alert storms arrive in bursts
+
+    def __init__(self, socket_file, shift_calendar):
+        """Bind to socket_file, replacing a stale socket left behind by a previous run."""
+        if os.path.exists(socket_file) and \
+                stat.S_ISSOCK(os.stat(socket_file).st_mode):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_file)
+            except socket.error:
+                os.unlink(socket_file)
+            else:
+                raise socket.error("%s is already being served" % socket_file)
+            finally:
+                probe.close()
+        SocketServer.UnixStreamServer.__init__(self, socket_file, ShiftRequestHandler)
+        os.chmod(socket_file, 0o660)
+        self.socket_file = socket_file
+        self.shift_calendar = shift_calendar
+        self.cache_mtime = None
+        self.synced_at = 0
+
+    def refresh(self):
+        """Re-sync the calendar if the on-disk cache was rewritten or has expired since the last lookup.
+
+        An expired cache is synced at most once per cache_fresh_ttl, so that
+        lookups in a burst do not each start a sync while the first one runs."""
+        fresh_ttl = self.shift_calendar.cache_fresh_ttl
+        if self.newest_cache_mtime() != self.cache_mtime or \
+                (self.shift_calendar.cache_age() >= fresh_ttl and
+                        time.time() - self.synced_at >= fresh_ttl):
+            self.shift_calendar.have_synced = False
+            self.shift_calendar.sync()
+            self.cache_mtime = self.newest_cache_mtime()
+            self.synced_at = time.time()
+
+    def newest_cache_mtime(self):
+        """Return the modification time of the most recently written cache file."""
+        return max(os.path.getmtime(filename)
+                for filename in self.shift_calendar.cache.files)
+
+    def answer(self, query):
+        """Return the answer to a query given as a list of words, raise LookupError if there is none."""
+        if len(query) != 2 or query[0] != "current" or \
+                query[1] not in ShiftRequestHandler.fields:
+            raise LookupError("unknown query")
+        self.refresh()
+        person = self.shift_calendar.get_current_person()
+        if person is None:
+            raise LookupError("no current person")
+        value = getattr(person, query[1])
+        if value is None:
+            raise LookupError("current person has no %s" % query[1])
+        return value
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_file)
+        except OSError:
+            pass
@@ -0,0 +1,144 @@
+"""HTTP transport for gdata clients that reuses connections and asks for compressed responses."""
+import time
+import zlib
+import socket
+import httplib
+import threading
+import atom.http_core
+from StringIO import StringIO
+
+# held while the default timeout of new sockets is changed, see PersistentHttpClient.open_connection
+DEFAULT_TIMEOUT_LOCK = threading.Lock()
+
+class PersistentHttpClient(atom.http_core.ProxiedHttpClient):
+    """An atom HttpClient that keeps connections alive between requests and asks for gzip compressed responses.
+
+    Like gdata's default ProxiedHttpClient, it connects through the proxy set
+    in the http_proxy or https_proxy environment variable, if any.
+
+    Connections are kept per thread and per host, so one instance can be shared
+    by several gdata clients, also when they are used from several threads.
+
+    If deadline is set to a time as returned by time.time(), requests time out
+    at that time and requests made after it raise DeadlineExceeded."""
+    def __init__(self):
+        self.local = threading.local()
+        self.deadline = None
+
+    def connections(self):
+        """Return the dictionary of open connections belonging to the current thread."""
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def _get_connection(self, uri, headers=None):
+        key = (uri.scheme, uri.host, uri.port)
+        connections = self.connections()
+        if key in connections and connections[key].sock is None and connections[key].host != uri.host:
+            # httplib would reopen a closed connection to the proxy itself,
+            # not through a new tunnel to the host behind it
+            del connections[key]
+        if key not in connections:
+            connections[key] = self.open_connection(uri, headers)
+        connection = connections[key]
+        if self.deadline is not None:
+            timeout = self.time_left()
+            connection.timeout = timeout # used when connecting
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+        return connection
+
+    def open_connection(self, uri, headers):
+        """Return a new connection for uri, from ProxiedHttpClient, setting up a tunnel through a proxy within the deadline.
+
+        ProxiedHttpClient connects to an https proxy and sends it CONNECT on a
+        socket it creates itself, so the deadline is applied as the default
+        timeout of new sockets while it does."""
+        if self.deadline is None:
+            return atom.http_core.ProxiedHttpClient._get_connection(self, uri, headers)
+        with DEFAULT_TIMEOUT_LOCK:
+            default_timeout = socket.getdefaulttimeout()
+            socket.setdefaulttimeout(self.time_left())
+            try:
+                return atom.http_core.ProxiedHttpClient._get_connection(self, uri, headers)
+            finally:
+                socket.setdefaulttimeout(default_timeout)
+
+    def time_left(self):
+        """Return the seconds left until the deadline, raise DeadlineExceeded if there are none."""
+        timeout = self.deadline - time.time()
+        if timeout <= 0:
+            raise DeadlineExceeded("deadline exceeded")
+        return timeout
+
+    def request(self, http_request):
+        uri = http_request.uri
+        if isinstance(uri, (str, unicode)):
+            uri = atom.http_core.Uri.parse_uri(uri)
+        headers = dict(http_request.headers)
+        headers['Accept-Encoding'] = 'gzip'
+        # Google only compresses responses to user agents that mention gzip
+        user_agent = headers.get('User-Agent', '')
+        if 'gzip' not in user_agent:
+            headers['User-Agent'] = ("%s (gzip)" % user_agent).strip()
+
+        key = (uri.scheme, uri.host, uri.port)
+        reused = key in self.connections()
+        if self.deadline is not None:
+            self.time_left()
+        try:
+            response = self._http_request(http_request.method, uri, headers,
+                    http_request._body_parts) # pylint: disable=W0212
+            return BufferedResponse(response)
+        except (httplib.HTTPException, socket.error):
+            connection = self.connections().pop(key, None)
+            if connection is not None: # None if connecting, e.g. to a proxy, failed
+                connection.close()
+            # the server may have closed a kept-alive connection while it was
+            # idle, which is worth one more try if the request can be repeated
+            if not reused or http_request.method != 'GET':
+                raise
+        response = self._http_request(http_request.method, uri, headers,
+                http_request._body_parts) # pylint: disable=W0212
+        return BufferedResponse(response)
+
+    Request = request
+
+    def close(self):
+        """Close all connections opened by the current thread."""
+        connections = self.connections()
+        while connections:
+            connections.popitem()[1].close()
+
+class DeadlineExceeded(socket.timeout):
+    """Raised when a request is made after the deadline set on a PersistentHttpClient."""
+    pass
+
+class BufferedResponse(object):
+    """An httplib response read in full, and decompressed if it was gzip encoded.
+
+    Reading the response right away lets its connection be reused for the next request."""
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.version = response.version
+        self.msg = response.msg
+        self.headers = response.getheaders()
+        body = response.read()
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.body = StringIO(body)
+
+    def getheader(self, name, default = None):
+        """Return the value of the named header, or default if it was not sent."""
+        return self.msg.getheader(name, default)
+
+    def getheaders(self):
+        """Return a list of (header, value) tuples."""
+        return self.headers
+
+    def read(self, amt = None):
+        """Return up to amt bytes of the (decompressed) body, or all of it."""
+        if amt is None:
+            return self.body.read()
+        return self.body.read(amt)